@@ -18,7 +18,7 @@ setup(
     author_email='roman.kiselew@gmail.com',
     packages=["speview"],
     package_dir={"speview": "src/speview"},
-    scripts=['src/speviewer'],
+    scripts=['src/speviewer', 'src/speview-batch'],
     url='https://github.com/ximeg/speview',
     license='LICENSE.txt',
     description='Program to display binary SPE files containing Raman spectra',
@@ -0,0 +1,224 @@
+"""
+ simple SPE file viewer (Raman spectra) - batch processing of folders
+ license: GNU GPL
+
+ All SPE files in a folder are read with the settings from its
+ .speview.conf (dark current correction, wavenumber calibration) and the
+ processed spectra are written into files. No GUI is required, figures
+ are rendered with the Agg backend.
+"""
+
+import numpy as np
+import os
+import multiprocessing
+import ConfigParser as cp
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from speview.reader import FileReader, default_config, excluded_files, is_spe
+from speview.store import SpectrumStore
+
+FORMATS = ("csv", "npy", "hdf5", "store")
+
+
+############################# Helper function #################################
+# read_config       - read .speview.conf of the folder or use the defaults
+# list_spe          - list of SPE files in the folder to be processed
+# get_reader        - FileReader for a folder (one per folder and process)
+# process_file      - read and process a single file, catch errors
+# process_many      - process many files in parallel (process pool)
+# save_figure       - plot spectra of a file and save the figure
+# process_directory - process all SPE files in a folder
+###############################################################################
+def read_config(directory):
+    """ Read config of the folder; if it is absent, just show the data. """
+    if os.path.exists(os.path.join(directory, ".speview.conf")):
+        cfg = cp.SafeConfigParser()
+        cfg.read(os.path.join(directory, ".speview.conf"))
+        return cfg
+    return default_config()
+
+
+def list_spe(cfg, directory="."):
+    """ Sorted list of SPE files except the calibration and dark ones. """
+    excluded = excluded_files(cfg)
+    return sorted(name for name in os.listdir(directory) if
+                  is_spe(name) and name not in excluded)
+
+
+_readers = {}  # { <folder> : FileReader }, separately in each process
+
+
+def get_reader(directory):
+    """
+    Return FileReader for the folder. The current directory must be
+    <directory>, because FileReader works with relative paths.
+    """
+    reader = _readers.get(directory)
+    if reader is None:
+        reader = FileReader(read_config("."), disk_cache=False)
+        _readers[directory] = reader
+    return reader
+
+
+def process_file(path):
+    """
+    Read and process all spectra of the file. Return tuple
+      (path, xvals, yvals, error)
+    where <yvals> has shape (nframes, npixels). If the file cannot be read,
+    <xvals> and <yvals> are None and <error> describes the problem.
+    """
+    directory, filename = os.path.split(os.path.abspath(path))
+    cwd = os.getcwd()
+    try:
+        os.chdir(directory)
+        xvals, yvals = get_reader(directory).read_frames(filename)
+        return path, xvals, yvals, None
+    except Exception as err:
+        return path, None, None, "%s: %s" % (type(err).__name__, err)
+    finally:
+        os.chdir(cwd)
+
+
+def process_many(paths, workers=None, chunksize=None):
+    """
+    Process SPE files given by <paths> in <workers> processes (default is
+    number of CPUs; 1 means no extra processes). Files are submitted to
+    the pool in chunks of <chunksize>. Yield results of process_file() in
+    the order of <paths> as soon as they are ready. A file which cannot be
+    read does not stop processing of others.
+    """
+    paths = list(paths)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    # Calibration (if it is not done yet) should run once per folder, not
+    # once per worker, so readers are created here before forking.
+    for directory in set(os.path.dirname(os.path.abspath(path))
+                         for path in paths):
+        cwd = os.getcwd()
+        try:
+            os.chdir(directory)
+            get_reader(directory)
+        finally:
+            os.chdir(cwd)
+
+    if workers <= 1 or len(paths) <= 1:
+        for path in paths:
+            yield process_file(path)
+        return
+
+    if chunksize is None:
+        chunksize = max(1, min(64, len(paths) // (4 * workers)))
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap(process_file, paths, chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def save_figure(filename, xvals, yvals, xlabel, outname):
+    """ Plot all spectra of the file and save the figure to <outname>. """
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.gca()
+    for y in yvals:
+        axes.plot(xvals, y, "#0000b0", lw=1.0)
+    axes.set_xlim(xvals.min(), xvals.max())
+    axes.margins(0.0, 0.05)
+    axes.yaxis.get_major_formatter().set_powerlimits((0, 4))
+    axes.set_title(filename)
+    axes.set_xlabel(xlabel)
+    axes.set_ylabel("Counts")
+    axes.grid(True)
+    figure.savefig(outname)
+
+
+def process_directory(directory, outdir=None, fmt="csv", figures=None,
+                      workers=1):
+    """
+    Process all SPE files in <directory> and write the results into
+    <outdir> (default is "<directory>/processed"). Spectra are written as
+      * csv  - one file per SPE file, the first column is the x-axis,
+               each next column contains one spectrum
+      * npy  - the same table saved in numpy format
+      * hdf5 - a single file "spectra.h5" with a group per SPE file,
+               which contains datasets "x" and "y" (requires h5py)
+      * store - the consolidated store of the folder (see speview.store),
+               only new and modified files are processed, <outdir> is
+               used only for figures
+    If <figures> is a file format (e.g. "png"), a figure is saved for each
+    file as well. Files are read by <workers> processes, see process_many.
+    Files which cannot be read are reported and skipped.
+    Return list of written files.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown output format '%s'" % fmt)
+    if fmt == "hdf5":
+        import h5py  # optional dependency
+    directory = os.path.abspath(directory)
+    if outdir is None:
+        outdir = os.path.join(directory, "processed")
+    outdir = os.path.abspath(outdir)
+    if (fmt != "store" or figures) and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    cwd = os.getcwd()
+    os.chdir(directory)  # FileReader works in the current directory
+    try:
+        cfg = read_config(".")
+        reader = get_reader(directory)
+        if reader.calibrated:
+            xlabel = "Wavenumber, cm$^{-1}$"
+        else:
+            xlabel = "pixel number"
+        written = []
+        h5file = None
+        filenames = list_spe(cfg)
+        if fmt == "hdf5":
+            h5file = h5py.File(os.path.join(outdir, "spectra.h5"), "w")
+            written.append(h5file.filename)
+        elif fmt == "store":
+            if reader.store is None:
+                reader.store = SpectrumStore(".")
+            filenames = [name for name in filenames
+                         if not reader.is_stored(name)]
+            written.append(os.path.abspath(reader.store.path))
+        for path, xvals, yvals, error in process_many(filenames, workers):
+            filename = os.path.basename(path)
+            if error:
+                print "FAILED: %s (%s)" % (os.path.join(directory, filename),
+                                           error)
+                continue
+            outname = os.path.join(outdir, os.path.splitext(filename)[0])
+            if fmt == "csv":
+                np.savetxt(outname + ".csv", np.column_stack((xvals, yvals.T)),
+                           delimiter=",")
+                written.append(outname + ".csv")
+            elif fmt == "npy":
+                np.save(outname + ".npy", np.column_stack((xvals, yvals.T)))
+                written.append(outname + ".npy")
+            elif fmt == "store":
+                reader.update_store(filename, xvals, yvals)
+            else:
+                group = h5file.create_group(filename)
+                group.create_dataset("x", data=xvals)
+                group.create_dataset("y", data=yvals)
+                group.attrs["fileinfo"] = reader.read_info(filename)
+            if figures:
+                save_figure(filename, xvals, yvals, xlabel,
+                            outname + "." + figures)
+                written.append(outname + "." + figures)
+            if fmt == "store":
+                outname = os.path.abspath(reader.store.path)
+            print "%s -> %s" % (os.path.join(directory, filename), outname)
+        if h5file:
+            h5file.close()
+        if fmt == "store":
+            reader.store.save()
+    finally:
+        os.chdir(cwd)
+    return written
@@ -0,0 +1,64 @@
+"""
+ simple SPE file viewer (Raman spectra) - wavenumber calibration
+ license: GNU GPL
+
+ The calibration (peak fitting with xcal_raman and rendering of the PDF
+ report) takes several seconds, so the viewer runs it in a separate
+ process with this module as the main program:
+     python -m speview.calibration <datafile> <darkfile> <material> <shift>
+ The coefficients are written into COEFFS_FILE as soon as they are
+ known, before the report is rendered. The file is replaced atomically,
+ so readers never see it half-written.
+"""
+
+import os
+import sys
+import subprocess
+
+COEFFS_FILE = "xcal_coeffs.csv"
+
+
+def start(cfg):
+    """
+    Start calibration of the current folder with the settings from <cfg>
+    in a background process. Return the process (subprocess.Popen).
+    """
+    args = [str(cfg.get("wavenum_calibration", option)) for option in
+            ("datafile", "darkfile", "material", "shift")]
+    # The package must be importable even if speview is not installed
+    env = dict(os.environ)
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    pythonpath = [package_dir]
+    if env.get("PYTHONPATH"):
+        pythonpath.append(env["PYTHONPATH"])
+    env["PYTHONPATH"] = os.pathsep.join(pythonpath)
+    return subprocess.Popen([sys.executable, "-m", "speview.calibration"] +
+                            args, env=env)
+
+
+def calibrate(datafile, darkfile, material, shift=0):
+    """
+    Calibrate the x-axis with the spectrum of a standard <material>, write
+    the coefficients into COEFFS_FILE and the report into
+    "calibration_report-<material>.pdf".
+    """
+    import matplotlib as m
+    m.use("Agg")  # no window is needed for the report
+    import pylab as pl
+    import numpy as np
+    import xcal_raman as xcal
+
+    figure = pl.figure()
+    dummy, coeffs = xcal.calibrate_spe(datafile, darkfile, material=material,
+                                       figure=figure, shift=shift)
+    np.savetxt(COEFFS_FILE + ".tmp", coeffs)
+    os.rename(COEFFS_FILE + ".tmp", COEFFS_FILE)
+    figure.savefig("calibration_report-" + material + ".pdf")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 5:
+        print "usage: python -m speview.calibration " \
+              "<datafile> <darkfile> <material> <shift>"
+        sys.exit(2)
+    calibrate(sys.argv[1], sys.argv[2], sys.argv[3], int(sys.argv[4]))
@@ -0,0 +1,238 @@
+"""
+ simple SPE file viewer (Raman spectra) - removal of cosmic-ray spikes
+ license: GNU GPL
+
+ Cosmic rays hitting the CCD produce narrow spikes of one or two pixels.
+ A pixel is a spike if it exceeds a reference spectrum by more than
+ <threshold> times the noise level, and is then replaced by the reference.
+ The reference is either
+   * "median" - the running median of the spectrum over <window> pixels,
+   * "frames" - the median of <window> neighbouring frames of the same
+     file, pixel by pixel (for series of spectra of the same sample).
+ Within a single spectrum, the tops of narrow Raman bands look like spikes
+ too. With the running median, a spike (one pixel or a pair of pixels)
+ must therefore also fall off steeply on both sides, whereas a band has
+ shoulders (see isolated).
+
+ The noise level of each spectrum is estimated from the median absolute
+ difference of neighbouring pixels, which is not affected by the bands.
+ The shot noise grows with the signal, so the variance of a pixel is this
+ level squared plus its signal above the typical level of the spectrum
+ (at most one count per photoelectron is assumed, i.e. the noise is not
+ underestimated). Whole stacks of spectra (array nframes x npixels) are
+ processed at once, without loops in python.
+
+ Check that the filter keeps the bands of real spectra with
+     python -m speview.cosmics testdata/*.SPE
+
+ The filter is the stage "cosmic_rays" of the preprocessing pipeline (see
+ speview.pipeline), configured in the section [cosmic_rays] of
+ .speview.conf:
+     [cosmic_rays]
+     method = median
+     window = 9
+     threshold = 8
+ The default window is 9 pixels for "median" and 5 frames for "frames".
+ Without the section [pipeline], "enabled = yes" turns the filter on.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# Standard deviation of white noise / median absolute difference of pixels
+NOISE_SCALE = 1.4826 / np.sqrt(2)
+
+
+def pixel_windows(stack, window):
+    """
+    Return array (nframes x npixels x <window>) of the pixels around each
+    pixel of <stack>, without copying. The spectra are mirrored at the
+    edges.
+    """
+    half = window // 2
+    padded = np.pad(stack, ((0, 0), (half, half)), "reflect")
+    nrows, ncols = stack.shape
+    rstride, cstride = padded.strides
+    return as_strided(padded, shape=(nrows, ncols, window),
+                      strides=(rstride, cstride, cstride))
+
+
+def running_median(stack, window):
+    """
+    Running median of each row of <stack> (nframes x npixels) over
+    <window> pixels (odd number).
+    """
+    half = window // 2
+    return np.partition(pixel_windows(stack, window), half, axis=-1)[..., half]
+
+
+def frame_windows(nframes, window):
+    """
+    Return first frame of the <window> neighbouring frames used for each
+    of <nframes> frames. The window is shifted inwards at both ends.
+    """
+    return np.clip(np.arange(nframes) - window // 2, 0, nframes - window)
+
+
+def frame_median(stack, window):
+    """
+    Median of <window> neighbouring rows (frames) of <stack>, pixel by
+    pixel (<window> is an odd number). Return array of the same shape as
+    <stack>.
+    """
+    nframes, npix = stack.shape
+    rstride, cstride = stack.strides
+    windows = as_strided(stack, shape=(nframes - window + 1, window, npix),
+                         strides=(rstride, rstride, cstride))
+    half = window // 2
+    median = np.partition(windows, half, axis=1)[:, half]
+    return median[frame_windows(nframes, window)]
+
+
+def isolated(stack, min_height=0, fraction=0.7):
+    """
+    Mask of pixels of <stack> which, alone or together with one neighbour,
+    stand out on both sides: the drop to the next pixel must be more than
+    <min_height> and more than <fraction> of the drop to the pixel after
+    it. Spikes fall off at once, bands (even the narrowest ones) have
+    shoulders.
+    """
+    padded = np.pad(stack, ((0, 0), (2, 3)), "reflect")
+    left2, left = padded[:, :-5], padded[:, 1:-4]
+    right, right2, right3 = padded[:, 3:-2], padded[:, 4:-1], padded[:, 5:]
+    steep = lambda top, near, far: \
+        top - near > np.maximum(fraction * (top - far), min_height)
+    single = steep(stack, left, left2) & steep(stack, right, right2)
+    # Pairs of pixels <i> and <i+1>
+    lower = np.minimum(stack, right)
+    pairs = steep(lower, left, left2) & steep(lower, right2, right3)
+    single[:, 1:] |= pairs[:, :-1]  # the right pixel of a pair
+    return single | pairs
+
+
+def row_noise(stack):
+    """
+    Return white noise level (from differences of neighbouring pixels) and
+    typical signal of each row of <stack>.
+    """
+    white = NOISE_SCALE * np.median(np.abs(np.diff(stack)), axis=-1)
+    return white, np.median(stack, axis=-1)
+
+
+def noise_level(white, level, signal):
+    """
+    Noise level of pixels with <signal> in rows with <white> noise and
+    typical signal <level>: the shot noise of the signal above the typical
+    level is added.
+    """
+    return np.maximum(np.sqrt(white**2 + np.maximum(signal - level, 0)),
+                      1e-12)
+
+
+def replace_spikes(stack, reference, threshold):
+    """
+    Replace pixels of <stack> exceeding <reference> by more than
+    <threshold> times their noise level. Return the cleaned stack (a copy)
+    and the mask of spikes.
+    """
+    white, level = row_noise(stack)
+    noise = noise_level(white[:, None], level[:, None], reference)
+    spikes = stack - reference > threshold * noise
+    return np.where(spikes, reference, stack), spikes
+
+
+def replace_isolated_spikes(stack, window, threshold):
+    """
+    Like replace_spikes() with the running median over <window> pixels as
+    the reference, but only pixels standing out from the pixels around
+    them are replaced (see isolated). The median is computed only for
+    these pixels.
+    """
+    white, level = row_noise(stack)
+    # A spike drops by most of its height (see isolated), at least by half
+    rows, cols = np.nonzero(isolated(stack, 0.5 * threshold * white[:, None]))
+    half = window // 2
+    reference = np.partition(pixel_windows(stack, window)[rows, cols], half,
+                             axis=-1)[:, half]
+    noise = noise_level(white[rows], level[rows], reference)
+    found = stack[rows, cols] - reference > threshold * noise
+    cleaned = stack.copy()
+    cleaned[rows[found], cols[found]] = reference[found]
+    spikes = np.zeros(stack.shape, dtype=bool)
+    spikes[rows[found], cols[found]] = True
+    return cleaned, spikes
+
+
+class SpikeFilter(object):
+    """ Removal of cosmic-ray spikes with the settings from <cfg> """
+    def __init__(self, cfg):
+        section = "cosmic_rays"
+        self.method = "median"
+        self.threshold = 8.0
+        if cfg.has_option(section, "method"):
+            self.method = cfg.get(section, "method")
+        self.window = 9 if self.method == "median" else 5
+        if cfg.has_option(section, "window"):
+            self.window = cfg.getint(section, "window") | 1  # odd number
+        if cfg.has_option(section, "threshold"):
+            self.threshold = cfg.getfloat(section, "threshold")
+        if self.method not in ("median", "frames"):
+            raise ValueError("Unknown method '%s' in section [%s]" %
+                             (self.method, section))
+
+    @staticmethod
+    def enabled(cfg):
+        """ Check if the filter is turned on in <cfg> """
+        return cfg.has_option("cosmic_rays", "enabled") and \
+            cfg.getboolean("cosmic_rays", "enabled")
+
+    @property
+    def key(self):
+        """ Settings affecting the result (part of the cache keys) """
+        return ("cosmic_rays", self.method, self.window, self.threshold)
+
+    def frames_needed(self, first, last, nframes):
+        """
+        Return range of frames needed to clean the frames <first>...
+        <last>-1 of a file with <nframes> frames.
+        """
+        if self.method != "frames" or nframes < self.window:
+            return first, last
+        starts = frame_windows(nframes, self.window)
+        return starts[first], starts[last - 1] + self.window
+
+    def __call__(self, stack):
+        """
+        Return <stack> (nframes x npixels) without spikes. With method
+        "frames" the stack must contain all frames needed for each frame
+        (see frames_needed), otherwise the running median is used.
+        """
+        stack = np.atleast_2d(np.asarray(stack, dtype=float))
+        if self.method == "frames" and len(stack) >= self.window:
+            reference = frame_median(stack, self.window)
+            return replace_spikes(stack, reference, self.threshold)[0]
+        return replace_isolated_spikes(stack, self.window, self.threshold)[0]
+
+
+if __name__ == "__main__":
+    import sys
+    import ConfigParser as cp
+    from speview.spefile import SPEFile
+
+    if len(sys.argv) < 2:
+        print "usage: python -m speview.cosmics <SPE file> ..."
+        sys.exit(2)
+    # Spectra with bands, but without spikes, must not change at maxima
+    cfg = cp.RawConfigParser()
+    spikes = SpikeFilter(cfg)
+    failed = False
+    for filename in sys.argv[1:]:
+        spe = SPEFile(filename)
+        lum = np.array([spe.spectrum(i) for i in range(len(spe))], float)
+        cleaned = spikes(lum)
+        changed = (cleaned != lum).sum()
+        kept = np.array_equal(cleaned.max(axis=-1), lum.max(axis=-1))
+        failed |= not kept
+        print "%-40s %5i pixels replaced, maxima %s" % \
+            (filename, changed, "kept" if kept else "CHANGED")
+    sys.exit(1 if failed else 0)
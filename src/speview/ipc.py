@@ -0,0 +1,126 @@
+"""
+ simple SPE file viewer (Raman spectra) - single-instance mode
+ license: GNU GPL
+
+ A running viewer listens on a local (unix domain) socket of its folder.
+ When speviewer is started for another file of the same folder, it sends
+ the file name through the socket and exits, and the running viewer shows
+ the file. This module uses only the standard library, so that the file
+ can be handed over before the slow import of matplotlib.
+"""
+
+import os
+import socket
+import hashlib
+import tempfile
+import threading
+import Queue
+import errno
+
+
+def socket_path(directory):
+    """ Name of the socket of the viewer showing files of <directory> """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    digest = hashlib.sha1(os.path.realpath(directory)).hexdigest()[:16]
+    return os.path.join(runtime_dir,
+                        "speview-%i-%s.sock" % (os.getuid(), digest))
+
+
+def connect(path, timeout=1.0):
+    """
+    Connect to the socket <path>. Return the socket or None if nobody is
+    listening; a socket file left by a crashed viewer is removed.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except socket.error as err:
+        sock.close()
+        if err.errno == errno.ECONNREFUSED:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return None
+    return sock
+
+
+def send(filename, timeout=1.0):
+    """
+    Hand <filename> over to a running viewer of its folder. Return True
+    if the viewer confirmed it, False if a new viewer should be started.
+    """
+    fullname = os.path.abspath(filename)
+    sock = connect(socket_path(os.path.dirname(fullname)), timeout)
+    if sock is None:
+        return False
+    try:
+        sock.sendall(os.path.basename(fullname) + "\n")
+        return sock.makefile().readline().strip() == "ok"
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+class HandoffServer(object):
+    """
+    Listener for file names sent by send() to the viewer of <directory>.
+    Connections are accepted in a background thread, which puts the names
+    into a queue. Use poll() to get them, close() to remove the socket.
+    Raise socket.error if another viewer of the folder is running.
+    """
+    def __init__(self, directory="."):
+        self.path = socket_path(directory)
+        self.queue = Queue.Queue()
+        sock = connect(self.path)
+        if sock is not None:
+            sock.close()
+            raise socket.error(errno.EADDRINUSE,
+                               "Another viewer is running in this folder")
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)  # other users must not use the socket
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(5)
+        thread = threading.Thread(target=self.serve, name="handoff")
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        """ Accept connections, read file names and confirm them """
+        while True:
+            try:
+                conn, address = self.sock.accept()
+            except socket.error:  # the socket was closed
+                return
+            try:
+                conn.settimeout(1.0)
+                name = conn.makefile().readline().strip()
+                if name:
+                    self.queue.put(name)
+                    conn.sendall("ok\n")
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+
+    def poll(self):
+        """ Return list of file names received since the last call """
+        names = []
+        while True:
+            try:
+                names.append(self.queue.get_nowait())
+            except Queue.Empty:
+                return names
+
+    def close(self):
+        """ Stop listening and remove the socket """
+        self.sock.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,72 @@
+"""
+ simple SPE file viewer (Raman spectra) - level of detail of plotted lines
+ license: GNU GPL
+
+ A spectrum with many more points than pixels on the screen is drawn in
+ reduced form: the visible range is divided into blocks, roughly one per
+ pixel column, and only the minimum and the maximum of each block are
+ plotted. The points are taken from the spectrum itself, so peaks keep
+ their exact positions and heights. When the user zooms in, there are
+ fewer points per column and the full data are shown.
+"""
+
+import numpy as np
+
+
+class MinMaxPyramid(object):
+    """
+    Positions of minima and maxima of the spectrum (xvals, yvals) in
+    blocks of 2**k points, for k = 0, 1, 2, ... Each level is computed
+    from the previous one when it is needed for the first time:
+      levels = [ (<indices of minima>, <indices of maxima>) ]
+    The x-axis must be ascending, otherwise the full data are returned.
+    """
+    def __init__(self, xvals, yvals):
+        self.xvals = np.asarray(xvals)
+        self.yvals = np.asarray(yvals)
+        self.ascending = len(xvals) < 2 or xvals[-1] >= xvals[0]
+        idx = np.arange(len(self.yvals))
+        self.levels = [(idx, idx)]
+
+    def level(self, k):
+        """ Return indices of minima and maxima in blocks of 2**k points """
+        y = self.yvals
+        while len(self.levels) <= k:
+            imin, imax = self.levels[-1]
+            if len(imin) % 2:  # the last block is incomplete
+                imin = np.append(imin, imin[-1])
+                imax = np.append(imax, imax[-1])
+            with np.errstate(invalid="ignore"):  # missing points (NaN)
+                left, right = imin[0::2], imin[1::2]
+                imin = np.where(y[right] < y[left], right, left)
+                left, right = imax[0::2], imax[1::2]
+                imax = np.where(y[right] > y[left], right, left)
+            self.levels.append((imin, imax))
+        return self.levels[k]
+
+    def view(self, xmin, xmax, width):
+        """
+        Return (xvals, yvals) of the part of the spectrum between <xmin>
+        and <xmax>, reduced to 2-4 points per pixel if the plot is <width>
+        pixels wide. One point beyond the range is added on each side.
+        """
+        x = self.xvals
+        if not self.ascending or width < 1:
+            return x, self.yvals
+        first = max(np.searchsorted(x, xmin) - 1, 0)
+        last = min(np.searchsorted(x, xmax, "right") + 1, len(x))
+        npoints = last - first
+        if npoints <= 2 * width:  # full detail
+            return x[first:last], self.yvals[first:last]
+        k = int(np.log2(npoints / float(width)))
+        imin, imax = self.level(k)
+        imin = imin[first >> k:((last - 1) >> k) + 1]
+        imax = imax[first >> k:((last - 1) >> k) + 1]
+        idx = np.column_stack((np.minimum(imin, imax),
+                               np.maximum(imin, imax))).ravel()
+        return x[idx], self.yvals[idx]
+
+
+def decimate(xvals, yvals, xmin, xmax, width):
+    """ Reduce the spectrum once, see MinMaxPyramid.view """
+    return MinMaxPyramid(xvals, yvals).view(xmin, xmax, width)
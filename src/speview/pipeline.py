@@ -0,0 +1,265 @@
+"""
+ simple SPE file viewer (Raman spectra) - preprocessing pipeline
+ license: GNU GPL
+
+ After the dark current correction, spectra pass through the stages listed
+ in the section [pipeline] of .speview.conf, in the given order, e.g.
+     [pipeline]
+     stages = cosmic_rays, baseline, smooth
+ The parameters of each stage are read from the section of the same name
+ (see STAGES). The wavenumber calibration is applied at the end.
+
+ The output of every stage is memoized frame by frame. The key of an
+ output is a hash of the key of its input and the stage parameters, and
+ the input of the first stage is identified by the file stamp and the
+ dark current settings. If a parameter of a stage changes, only this stage
+ and the following ones are computed again.
+
+ A stage is an object with the following interface:
+   * constructor taking the config (ConfigParser),
+   * key - tuple of name and parameters affecting the result,
+   * frames_needed(first, last, nframes) - range of input frames needed
+     to compute output frames first...last-1 of a file with nframes,
+   * __call__(stack) - process array (nframes x npixels) and return the
+     result of the same shape.
+ New stages can be added with register().
+"""
+
+import numpy as np
+import hashlib
+import threading
+import re
+from collections import OrderedDict
+from numpy.lib.stride_tricks import as_strided
+
+from speview.cosmics import SpikeFilter
+
+
+################################# Stages ######################################
+# Stage     - base class of stages, reading parameters from the config
+# Baseline  - removal of the fluorescence background (modified polyfit)
+# Smooth    - Savitzky-Golay smoothing
+# Normalize - division by the maximum or by the area of the spectrum
+###############################################################################
+class Stage(object):
+    """
+    Stage of the pipeline working frame by frame. Parameters are read from
+    the section <name> of the config; their defaults (and types) are given
+    by <defaults>.
+    """
+    name = None
+    defaults = {}  # { <option> : <default value> }
+
+    def __init__(self, cfg):
+        for option, default in self.defaults.iteritems():
+            value = default
+            if cfg.has_option(self.name, option):
+                value = type(default)(cfg.get(self.name, option))
+            setattr(self, option, value)
+
+    @property
+    def key(self):
+        """ Settings affecting the result """
+        return (self.name,) + tuple((option, getattr(self, option))
+                                    for option in sorted(self.defaults))
+
+    def frames_needed(self, first, last, nframes):
+        """ Frames are processed independently """
+        return first, last
+
+    def __call__(self, stack):
+        raise NotImplementedError
+
+
+class Baseline(Stage):
+    """
+    Subtract the background approximated by a polynomial of order <order>.
+    The polynomial is fitted <iterations> times, each time the spectrum is
+    clipped by the previous fit, so that the bands are excluded.
+    """
+    name = "baseline"
+    defaults = {"order": 3, "iterations": 20}
+
+    def __call__(self, stack):
+        npix = stack.shape[1]
+        vander = np.vander(np.linspace(-1, 1, npix), self.order + 1)
+        solver = np.linalg.pinv(vander)  # least-squares fit of the rows
+        base = stack
+        for i in range(max(self.iterations, 1)):
+            fit = np.dot(np.dot(base, solver.T), vander.T)
+            base = np.minimum(base, fit)
+        return stack - fit
+
+
+class Smooth(Stage):
+    """ Savitzky-Golay filter: polynomial <order> over <window> pixels """
+    name = "smooth"
+    defaults = {"window": 7, "order": 2}
+
+    def __call__(self, stack):
+        half = self.window // 2
+        offsets = np.arange(-half, half + 1, dtype=float)
+        coeffs = np.linalg.pinv(np.vander(offsets, self.order + 1))[-1]
+        padded = np.pad(stack, ((0, 0), (half, half)), "reflect")
+        nrows, ncols = stack.shape
+        rstride, cstride = padded.strides
+        windows = as_strided(padded, shape=(nrows, ncols, 2 * half + 1),
+                             strides=(rstride, cstride, cstride))
+        return np.dot(windows, coeffs)
+
+
+class Normalize(Stage):
+    """ Divide spectra by their maximum or by their area (<to>) """
+    name = "normalize"
+    defaults = {"to": "max"}
+
+    def __call__(self, stack):
+        if self.to == "area":
+            norm = np.abs(stack).sum(axis=-1)
+        elif self.to == "max":
+            norm = np.abs(stack).max(axis=-1)
+        else:
+            raise ValueError("Unknown option to=%s in section [%s]" %
+                             (self.to, self.name))
+        norm[norm == 0] = 1.0
+        return stack / norm[:, None]
+
+
+# Known stages { <name> : <class> }
+STAGES = {"cosmic_rays": SpikeFilter,
+          "baseline": Baseline,
+          "smooth": Smooth,
+          "normalize": Normalize}
+
+
+def register(name, stage):
+    """ Make the stage (class, see the interface above) known as <name> """
+    STAGES[name] = stage
+
+
+################################ Pipeline #####################################
+# MemoCache - bounded LRU cache of intermediate results
+# Pipeline  - sequence of stages with memoized outputs
+###############################################################################
+class MemoCache(object):
+    """
+    Outputs of stages, one frame per entry: data = { <key> : yvals }.
+    The least recently used entries are dropped as soon as the total size
+    exceeds <max_bytes>.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.data = OrderedDict()  # the oldest entry comes first
+        self.lock = threading.Lock()  # the cache is filled by Prefetcher
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        """ Return the cached array or None """
+        with self.lock:
+            yvals = self.data.pop(key, None)
+            if yvals is not None:
+                self.data[key] = yvals  # the most recently used
+            return yvals
+
+    def put(self, key, yvals):
+        """ Store the array and evict old entries if necessary """
+        with self.lock:
+            if key in self.data:
+                self.nbytes -= self.data.pop(key).nbytes
+            self.data[key] = yvals
+            self.nbytes += yvals.nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self.data.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        """ Drop all entries """
+        with self.lock:
+            self.data.clear()
+            self.nbytes = 0
+
+
+class Pipeline(object):
+    """
+    Stages configured in <cfg>: stages = [ (<name>, <stage>) ]. Without
+    the section [pipeline], the option "enabled" of the section
+    [cosmic_rays] turns on the spike filter alone.
+    """
+    def __init__(self, cfg):
+        if cfg.has_option("pipeline", "cache_size"):  # in megabytes
+            cache_size = cfg.getfloat("pipeline", "cache_size")
+        else:
+            cache_size = 32
+        self.memo = MemoCache(int(cache_size * 2**20))
+        self.configure(cfg)
+
+    def configure(self, cfg):
+        """
+        Create the stages from <cfg>. The memoized outputs are kept, so
+        stages whose parameters did not change are not computed again.
+        """
+        if cfg.has_option("pipeline", "stages"):
+            names = re.split(r"[\s,]+", cfg.get("pipeline", "stages").strip())
+            names = [name for name in names if name]
+        elif SpikeFilter.enabled(cfg):
+            names = ["cosmic_rays"]
+        else:
+            names = []
+        for name in names:
+            if name not in STAGES:
+                raise ValueError("Unknown stage '%s' in section [pipeline]"
+                                 % name)
+        self.stages = [(name, STAGES[name](cfg)) for name in names]
+
+    def __len__(self):
+        return len(self.stages)
+
+    @property
+    def key(self):
+        """ Settings of all stages (part of the cache keys) """
+        return tuple(stage.key for name, stage in self.stages)
+
+    def __call__(self, stack):
+        """ Process all frames of a file at once, without memoization """
+        for name, stage in self.stages:
+            stack = stage(stack)
+        return stack
+
+    def run(self, source, origin, frame, nframes):
+        """
+        Return the processed frame <frame> of a file with <nframes> frames.
+        <source>(first, last) returns the input frames first...last-1 as an
+        array (nframes x npixels), <origin> identifies the input.
+        """
+        stages = [stage for name, stage in self.stages]  # may be replaced
+        digests = [hashlib.sha1(repr(origin)).hexdigest()]
+        for stage in stages:
+            digests.append(hashlib.sha1(digests[-1] +
+                                        repr(stage.key)).hexdigest())
+        return self.output(source, stages, digests, len(stages), frame,
+                           frame + 1, nframes)[0]
+
+    def output(self, source, stages, digests, level, first, last, nframes):
+        """
+        Return output frames first...last-1 of the stage number <level>
+        (0 is the input of the pipeline), computed only if necessary.
+        """
+        keys = [(digests[level], i) for i in range(first, last)]
+        rows = [self.memo.get(key) for key in keys]
+        if all(row is not None for row in rows):
+            return np.array(rows)
+        if level == 0:
+            stack = source(first, last)
+        else:
+            stage = stages[level - 1]
+            start, stop = stage.frames_needed(first, last, nframes)
+            stack = self.output(source, stages, digests, level - 1, start,
+                                stop, nframes)
+            stack = stage(stack)[first - start:last - start].copy()
+        # Memoized arrays are shared between callers, protect them
+        stack.flags.writeable = False
+        for key, row in zip(keys, stack):
+            self.memo.put(key, row)
+        return stack
@@ -0,0 +1,561 @@
+"""
+ simple SPE file viewer (Raman spectra) - reading and processing of data
+ license: GNU GPL
+
+ This module does not depend on the GUI and can be used for batch
+ processing (see speview.batch).
+"""
+
+import numpy as np
+import os
+import threading
+import hashlib
+import ConfigParser as cp
+from collections import OrderedDict
+
+from speview.spefile import SPEFile
+from speview.store import SpectrumStore
+from speview.stitch import Stitcher, stitch
+from speview.pipeline import Pipeline
+from speview import calibration
+
+
+############################# Helper function #################################
+# is_spe         - check if the file is an SPE file
+# excluded_files - calibration and dark files, which are not displayed
+# file_stamp     - modification time and size of a file (None if it is absent)
+# default_config - config used if there is no .speview.conf in the folder
+###############################################################################
+def is_spe(filename):
+    """ Check if <filename> has extension of SPE files. """
+    return filename.endswith(".SPE") or filename.endswith(".spe")
+
+
+def excluded_files(cfg):
+    """ Return set of calibration and dark files mentioned in config. """
+    names = set()
+    for section, option in (("wavenum_calibration", "datafile"),
+                            ("wavenum_calibration", "darkfile"),
+                            ("general", "darkfile")):
+        try:
+            names.add(cfg.get(section, option))
+        except (cp.NoOptionError, cp.NoSectionError):
+            pass
+    return names
+
+
+def file_stamp(filename):
+    """ Return (mtime, size) of the file, or None if it does not exist. """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+
+def default_config():
+    """ Return config without calibration and dark current correction. """
+    cfg = cp.RawConfigParser()
+    cfg.add_section("general")
+    cfg.add_section("wavenum_calibration")
+    cfg.set("general", "wavenum_calibration", "no")
+    cfg.set("general", "use_dark", "no")
+    return cfg
+
+
+################################### Classes ###################################
+# SpectrumCache - LRU cache of processed spectra with a memory budget
+# DiskCache     - persistent cache of processed spectra shared by sessions
+# Calibration   - conversion of pixel numbers into wavenumbers
+# DarkFrames    - dark current spectra read once and kept in memory
+# FileReader    - reading of SPE files and data calibration
+###############################################################################
+class SpectrumCache(object):
+    """
+    Bounded LRU cache of processed spectra. Entries are stored as
+      data = { <key> : (<stamp>, xvals, yvals) }
+    where <key> identifies the file together with the processing settings
+    and <stamp> is the (mtime, size) of the file at the time it was read.
+    An entry whose stamp differs from the current one is treated as a miss,
+    so spectra modified on disk are read again. The least recently used
+    entries are dropped as soon as the total size exceeds <max_bytes>.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.data = OrderedDict()  # the oldest entry comes first
+        self.lock = threading.Lock()  # the cache is filled by Prefetcher
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, stamp):
+        """ Return cached (xvals, yvals) or None if there is no valid entry """
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] != stamp:  # the file has changed on disk
+                self.nbytes -= entry[1].nbytes + entry[2].nbytes
+                return None
+            self.data[key] = entry  # move it to the end (most recently used)
+            return entry[1:]
+
+    def put(self, key, stamp, item):
+        """ Store (xvals, yvals) and evict old entries if necessary """
+        xvals, yvals = item
+        size = xvals.nbytes + yvals.nbytes
+        # Cached arrays are shared between callers, protect them
+        xvals.flags.writeable = False
+        yvals.flags.writeable = False
+        with self.lock:
+            if key in self.data:
+                old = self.data.pop(key)
+                self.nbytes -= old[1].nbytes + old[2].nbytes
+            if size > self.max_bytes:
+                return
+            self.data[key] = (stamp, xvals, yvals)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                old = self.data.popitem(last=False)[1]
+                self.nbytes -= old[1].nbytes + old[2].nbytes
+
+    def clear(self):
+        """ Drop all cached spectra """
+        with self.lock:
+            self.data.clear()
+            self.nbytes = 0
+
+
+class DiskCache(object):
+    """
+    Persistent cache of processed spectra in the folder <path>, shared by
+    all sessions. Each spectrum is saved as a separate .npy file named by
+    a hash of its key. The key should describe everything the result
+    depends on: path, mtime and size of the SPE file, frame number and
+    processing settings (calibration and dark file). When the total size
+    exceeds <max_bytes>, the least recently used files are deleted.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.nbytes = sum(os.path.getsize(os.path.join(path, name))
+                          for name in os.listdir(path))
+
+    def filename(self, key):
+        """ Name of the cache file for <key> """
+        return os.path.join(self.path,
+                            hashlib.sha1(repr(key)).hexdigest() + ".npy")
+
+    def get(self, key):
+        """ Return (xvals, yvals) or None if the spectrum is not cached """
+        filename = self.filename(key)
+        try:
+            xvals, yvals = np.load(filename)
+            os.utime(filename, None)  # mark as recently used
+        except (IOError, OSError, ValueError):
+            return None
+        return xvals, yvals
+
+    def put(self, key, item):
+        """ Save (xvals, yvals) and remove old files if necessary """
+        filename = self.filename(key)
+        tmpname = "%s.%i.tmp" % (filename, os.getpid())
+        try:
+            with open(tmpname, "wb") as fobj:
+                np.save(fobj, np.vstack(item))
+            os.rename(tmpname, filename)  # other sessions never see half
+            size = os.path.getsize(filename)
+        except (IOError, OSError):
+            return
+        with self.lock:
+            self.nbytes += size
+            if self.nbytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """ Delete the least recently used files, keep 80% of the budget """
+        entries = []
+        for name in os.listdir(self.path):
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:  # removed by another session
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        entries.sort()
+        self.nbytes = sum(size for mtime, size, name in entries)
+        for mtime, size, name in entries:
+            if self.nbytes <= 0.8 * self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            self.nbytes -= size
+
+
+class Calibration(object):
+    """
+    Conversion of pixel numbers into wavenumbers. The coefficients of the
+    calibration polynomial are read from <filename> only once and are
+    reloaded if the file changes. The x-axis is computed once per detector
+    width and shared by all spectra. If <filename> is None or the file does
+    not exist (yet), the x-axis contains pixel numbers. If <frozen> is True,
+    the coefficients are loaded only by update(), so that the viewer can
+    move the held lines to the new axis at the same time.
+    """
+    def __init__(self, filename=None, frozen=False):
+        self.filename = filename
+        self.frozen = frozen
+        self.coeffs = None
+        self.stamp = None
+        self.axes = {}  # { <number of pixels> : x-axis }
+        self.lock = threading.Lock()
+        if filename:
+            self.update()
+
+    def check(self):
+        """ Reload coefficients if the file changed. Return its stamp. """
+        if not self.frozen:
+            self.update()
+        return self.stamp
+
+    def update(self):
+        """ Reload coefficients if the file changed. Return True if so. """
+        changed = False
+        if self.filename:
+            stamp = file_stamp(self.filename)
+            if stamp != self.stamp:
+                with self.lock:
+                    if stamp is None:
+                        self.coeffs = None
+                    else:
+                        self.coeffs = np.atleast_1d(np.loadtxt(self.filename))
+                    self.stamp = stamp
+                    self.axes = {}
+                changed = True
+        return changed
+
+    def axis(self, npix):
+        """ Return x-axis for a detector with <npix> pixels. """
+        with self.lock:
+            xvals = self.axes.get(npix)
+            if xvals is None:
+                xvals = self(np.arange(npix, dtype=float))
+                xvals.flags.writeable = False
+                self.axes[npix] = xvals
+            return xvals
+
+    def __call__(self, pixels):
+        if self.coeffs is None:
+            return np.asarray(pixels, dtype=float)
+        return np.polyval(self.coeffs, pixels)
+
+
+class DarkFrames(object):
+    """
+    Dark current spectra. Each dark file is read only once and kept in
+    memory until it changes on disk:
+      frames = { <dark file> : (<stamp>, lum) }
+    A file "<name>dark.SPE" next to the data file "<name>SPE" overrides
+    the <default> dark file. The dark file used for each data file is
+    looked up only once and then remembered.
+    """
+    def __init__(self, default=None):
+        self.default = default
+        self.overrides = {}  # { <data file> : <dark file> }
+        self.frames = {}
+
+    def find(self, filename):
+        """ Return name of the dark file for <filename> """
+        darkfile = self.overrides.get(filename)
+        if darkfile is None:
+            darkfile = self.default
+            for name in (filename[:-3] + "dark.SPE",
+                         filename[:-3] + "dark.spe"):
+                if os.path.exists(name):
+                    darkfile = name
+                    break
+            self.overrides[filename] = darkfile
+        return darkfile
+
+    def load(self, darkfile, stamp):
+        """ Return the dark spectrum, read it if it is absent or changed """
+        frame = self.frames.get(darkfile)
+        if frame is None or frame[0] != stamp:
+            frame = (stamp, SPEFile(darkfile).spectrum().astype(float))
+            self.frames[darkfile] = frame
+        return frame[1]
+
+    def forget(self, darkfile):
+        """ A new dark file appeared, look up its data files again """
+        for ext in ("SPE", "spe"):
+            self.overrides.pop(darkfile[:-8] + ext, None)
+
+    def subtract(self, lum, darkfile, stamp):
+        """ Return <lum> with the dark spectrum subtracted """
+        return np.subtract(lum, self.load(darkfile, stamp))
+
+
+class FileReader(object):
+    """ Reading of SPE files and calibration of data """
+    def __init__(self, cfg, disk_cache=True, background=False):
+        """
+        Check if the calibration is required and perform it. If
+        <background> is True, do not wait for the calibration: until it is
+        finished, spectra have the pixel axis and the calibration is frozen
+        (see calibration_running and Calibration).
+        Set <disk_cache> to False to avoid using the persistent cache.
+        """
+        self.cfg = cfg
+        if cfg.has_option("general", "cache_size"):  # in megabytes
+            cache_size = cfg.getfloat("general", "cache_size")
+        else:
+            cache_size = 64
+        self.cache = SpectrumCache(int(cache_size * 2**20))
+        self.disk_cache = None
+        if disk_cache:
+            if cfg.has_option("general", "disk_cache_size"):  # in megabytes
+                disk_cache_size = cfg.getfloat("general", "disk_cache_size")
+            else:
+                disk_cache_size = 256
+            if cfg.has_option("general", "disk_cache"):
+                path = os.path.expanduser(cfg.get("general", "disk_cache"))
+            else:
+                path = os.path.join(os.environ.get("XDG_CACHE_HOME",
+                                    os.path.expanduser("~/.cache")), "speview")
+            if disk_cache_size > 0:
+                try:
+                    self.disk_cache = DiskCache(path,
+                                                int(disk_cache_size * 2**20))
+                except OSError as err:
+                    print "Cannot use disk cache '%s': %s" % (path, err)
+        self.handles = OrderedDict()  # { <filename> : (<stamp>, SPEFile) }
+        self.lock = threading.Lock()
+        if cfg.has_option("general", "use_store") and \
+           cfg.getboolean("general", "use_store"):
+            self.store = SpectrumStore(".")
+        else:
+            self.store = None
+        if cfg.get("general", "use_dark") == "yes":
+            self.darks = DarkFrames(cfg.get("general", "darkfile"))
+        else:
+            self.darks = None
+        self.pipeline = Pipeline(cfg)
+        if cfg.has_section("stitch"):
+            self.stitcher = Stitcher(cfg)
+        else:
+            self.stitcher = None
+        self.calibration_job = None
+        if cfg.get("general", "wavenum_calibration") == "yes":
+            # check if calibration coefficients are available
+            if not os.path.exists(calibration.COEFFS_FILE):
+                self.calibration_job = calibration.start(cfg)
+                if not background:
+                    if self.calibration_job.wait() != 0:
+                        raise RuntimeError("Calibration failed")
+                    self.calibration_job = None
+            self.calibration = Calibration(
+                calibration.COEFFS_FILE,
+                frozen=self.calibration_job is not None)
+        else:
+            self.calibration = Calibration()
+
+    @property
+    def calibrated(self):
+        """ True if the x-axis is in wavenumbers """
+        return self.calibration.check() is not None
+
+    def calibration_running(self):
+        """ Check if the calibration is still running in background """
+        job = self.calibration_job
+        if job is None or job.poll() is None:
+            return job is not None
+        self.calibration_job = None
+        if job.returncode != 0:
+            print "Calibration failed, the pixel axis is used"
+        return False
+
+    def configure_pipeline(self, cfg):
+        """
+        Take the preprocessing stages from <cfg>. Intermediate results of
+        the stages which did not change are reused.
+        """
+        self.pipeline.configure(cfg)
+
+    def find_dark(self, filename):
+        """ Return name of the dark file for <filename> or None """
+        if self.darks:
+            return self.darks.find(filename)
+        return None
+
+    def settings_key(self, darkfile):
+        """ Describe the processing settings, which affect the result """
+        calibration = self.calibration.check()
+        if darkfile:
+            settings = (calibration, darkfile, file_stamp(darkfile))
+        else:
+            settings = (calibration, None, None)
+        if self.pipeline:
+            settings += (self.pipeline.key,)
+        return settings
+
+    def open_spe(self, filename, stamp=None):
+        """ Return opened SPE file. A few recently used files stay open. """
+        if stamp is None:
+            stamp = file_stamp(filename)
+        with self.lock:
+            handle = self.handles.pop(filename, None)
+            if handle is None or handle[0] != stamp:
+                handle = (stamp, SPEFile(filename))
+            self.handles[filename] = handle
+            if len(self.handles) > 16:
+                self.handles.popitem(last=False)
+        return handle[1]
+
+    def is_stitched(self, filename):
+        """ Check if <filename> is a virtual file of stitched windows """
+        return self.stitcher is not None and filename in self.stitcher
+
+    def frames(self, filename):
+        """ Return number of frames (spectra) in the file. """
+        if self.is_stitched(filename):
+            return min(self.frames(member)
+                       for member in self.stitcher.groups[filename])
+        return len(self.open_spe(filename))
+
+    def read_spe(self, filename, frame=0):
+        """
+        Read data from SPE file and apply calibration function on it.
+        Only the frame <frame> is read from a file with several spectra.
+        After the dark current correction, the stages of the preprocessing
+        pipeline are applied (see speview.pipeline).
+        Processed spectra are kept in the cache until the file changes,
+        and in the persistent disk cache for the next sessions. If the
+        consolidated store is used, up-to-date data are taken from it.
+        """
+        if self.is_stitched(filename):
+            return self.read_stitched(filename, frame)
+        darkfile = self.find_dark(filename)
+        settings = self.settings_key(darkfile)
+        key = (filename, frame, settings)
+        stamp = file_stamp(filename)
+        item = self.cache.get(key, stamp)
+        if item is None and self.store:
+            item = self.store.get(filename, frame, stamp, repr(settings))
+            if item is not None:
+                return item
+        if item is None:
+            if self.disk_cache:
+                disk_key = (os.path.abspath(filename), stamp, frame,
+                            os.getcwd(), settings)
+                item = self.disk_cache.get(disk_key)
+            if item is None:
+                spe = self.open_spe(filename, stamp)
+                if self.pipeline:
+                    origin = (os.path.abspath(filename), stamp, settings[1:3])
+                    source = lambda first, last: self.decode(
+                        spe, first, last, darkfile, settings)
+                    lum = self.pipeline.run(source, origin, frame, len(spe))
+                else:
+                    lum = self.decode(spe, frame, frame + 1, darkfile,
+                                      settings)[0]
+                item = (self.calibration.axis(len(lum)), lum)
+                if self.disk_cache:
+                    self.disk_cache.put(disk_key, item)
+            self.cache.put(key, stamp, item)
+        return item
+
+    def decode(self, spe, first, last, darkfile, settings):
+        """
+        Return frames <first>...<last>-1 of the SPEFile <spe> as an array
+        (nframes x npixels) with the dark spectrum subtracted. This is the
+        input of the preprocessing pipeline.
+        """
+        raw = spe.data[first:last]
+        lum = raw.transpose(0, 2, 1).reshape(len(raw), -1).astype(float)
+        if darkfile:
+            lum = self.darks.subtract(lum, darkfile, settings[2])
+        return lum
+
+    def read_frames(self, filename):
+        """
+        Read all spectra of the file. Return x-axis and array of shape
+        (nframes, npixels). The frames are processed together, which is
+        much faster than read_spe() for each of them, but they are not
+        put into the caches.
+        """
+        if self.is_stitched(filename):
+            frames = [self.read_spe(filename, i)
+                      for i in range(self.frames(filename))]
+            return frames[0][0], np.array([yvals for xvals, yvals in frames])
+        darkfile = self.find_dark(filename)
+        spe = self.open_spe(filename)
+        lum = self.pipeline(self.decode(spe, 0, len(spe), darkfile,
+                                        self.settings_key(darkfile)))
+        return self.calibration.axis(lum.shape[1]), lum
+
+    def read_stitched(self, filename, frame=0):
+        """
+        Stitch the frame <frame> of a series of step-and-glue files (see
+        speview.stitch). The windows are read with read_spe(), so they are
+        taken from the caches if possible. The result is kept in the cache
+        until one of the files changes.
+        """
+        members = self.stitcher.groups[filename]
+        key = (filename, frame, tuple(members),
+               tuple(self.settings_key(self.find_dark(member))
+                     for member in members))
+        stamp = tuple(file_stamp(member) for member in members)
+        item = self.cache.get(key, stamp)
+        if item is None:
+            windows = []
+            for index, member in enumerate(members):
+                xvals, yvals = self.read_spe(member, frame)
+                xvals = self.stitcher.axis(self.open_spe(member), index,
+                                           xvals, self.calibrated)
+                windows.append((xvals, yvals))
+            item = stitch(windows)
+            self.cache.put(key, stamp, item)
+        return item
+
+    def store_key(self, filename):
+        """ Return (stamp, settings) describing the file in the store. """
+        return (file_stamp(filename),
+                repr(self.settings_key(self.find_dark(filename))))
+
+    def is_stored(self, filename):
+        """ Check if the store contains up-to-date data of the file. """
+        stamp, settings = self.store_key(filename)
+        return self.store.get(filename, 0, stamp, settings) is not None
+
+    def update_store(self, filename, xvals=None, yvals=None):
+        """
+        Put all processed spectra of the file into the store, unless they
+        are up to date. Already processed data (x-axis and array of shape
+        nframes x npixels) can be given as <xvals>, <yvals>. Call
+        store.save() afterwards to write the index.
+        """
+        stamp, settings = self.store_key(filename)
+        if self.store.get(filename, 0, stamp, settings) is not None:
+            return
+        if yvals is None:
+            xvals, yvals = self.read_frames(filename)
+        self.store.put(filename, stamp, settings, xvals, yvals,
+                       self.read_info(filename))
+
+    def read_info(self, filename):
+        """ Read acquisition information and comments from the file. """
+        if self.is_stitched(filename):
+            return "\n\n".join("%s:\n%s" % (member, self.read_info(member))
+                               for member in self.stitcher.groups[filename])
+        return self.open_spe(filename).fileinfo
+
+    def read_other_data_format(self, filename):
+        """ TODO Use data from some other file. """
+        print self.calibrated
+        print "read_other_data_format({}) - NOT IMPLEMENTED".format(filename)
+        raise NotImplementedError
@@ -0,0 +1,142 @@
+"""
+ simple SPE file viewer (Raman spectra) - reading of binary SPE files
+ license: GNU GPL
+
+ The SPE file generated by WinView/WinSpec (Princeton Instruments) consists
+ of a 4100 byte header followed by the data: <nframes> frames, each one is
+ an image of <ny> rows and <nx> columns. The file is memory-mapped, so only
+ the frames which are actually used are read from disk.
+"""
+
+import numpy as np
+import textwrap
+
+HEADER_SIZE = 4100
+
+# Fields of the header used by speview (name, format, offset in bytes)
+HEADER_FIELDS = [
+    ("controllerVersion",   "<i2",   0),
+    ("exposure_sec",        "<f4",  10),
+    ("date",                "S9",   20),
+    ("noscan",              "<i2",  34),
+    ("detectorTemp_C",      "<f4",  36),
+    ("nx",                  "<u2",  42),
+    ("SpecCenterWlNm",      "<f4",  72),
+    ("SpecGlueFlag",        "<i2",  76),
+    ("dataType",            "<i2", 108),
+    ("pimaxUsed",           "<i2", 144),
+    ("pimaxMode",           "<i2", 146),
+    ("pimaxGain",           "<i2", 148),
+    ("gain",                "<u2", 198),
+    ("comments",            "S400", 200),
+    ("ny",                  "<u2", 656),
+    ("accumulations",       "<i2", 668),
+    ("swVersion",           "S16", 688),
+    ("NumExpAccums",        "<i4", 1422),
+    ("nframes",             "<i4", 1446),
+    ("headerVersion",       "<f4", 1992),
+    ("calib_valid",         "u1",  3098),
+    ("polynom_order",       "u1",  3101),
+    ("polynom_coeff",       ("<f8", 6), 3263),
+    ("laser_position",      "<f8", 3311),
+    ("analogGain",          "<i2", 4092),
+]
+
+HEADER = np.dtype({"names": [name for name, fmt, offset in HEADER_FIELDS],
+                   "formats": [fmt for name, fmt, offset in HEADER_FIELDS],
+                   "offsets": [offset for name, fmt, offset in HEADER_FIELDS],
+                   "itemsize": HEADER_SIZE})
+
+# Data type of pixels: (numpy dtype, format character used by winspec)
+DATATYPES = {0: ("<f4", "f"),  # float
+             1: ("<i4", "l"),  # long
+             2: ("<i2", "h"),  # short
+             3: ("<u2", "H")}  # unsigned short
+
+
+class SPEFile(object):
+    """
+    Binary SPE file opened as a memory map. Attributes:
+        * self.header - numpy record with the header fields (see HEADER)
+        * self.nx, self.ny - number of columns and rows in a frame
+        * self.nframes - number of frames (complete frames only)
+        * self.data - array of shape (nframes, ny, nx) without data copying
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.mmap = np.memmap(filename, dtype=np.uint8, mode="r")
+        if self.mmap.size < HEADER_SIZE:
+            raise ValueError("File '%s' is too short for an SPE file" %
+                             filename)
+        self.header = self.mmap[:HEADER_SIZE].view(HEADER)[0]
+        datatype = int(self.header["dataType"])
+        if datatype not in DATATYPES:
+            raise ValueError("Unknown data type %i in file '%s'" %
+                             (datatype, filename))
+        self.dtype = np.dtype(DATATYPES[datatype][0])
+        self.nx = int(self.header["nx"])
+        self.ny = int(self.header["ny"])
+
+        # The file can be incomplete (e.g. it is still being written)
+        framesize = self.nx * self.ny * self.dtype.itemsize
+        available = (self.mmap.size - HEADER_SIZE) // max(framesize, 1)
+        self.nframes = int(min(self.header["nframes"], available))
+        self.data = self.mmap[HEADER_SIZE:HEADER_SIZE +
+                              self.nframes * framesize].view(self.dtype)
+        self.data = self.data.reshape(self.nframes, self.ny, self.nx)
+
+    def __len__(self):
+        return self.nframes
+
+    def frame(self, idx=0):
+        """ Return frame <idx> as an array (ny, nx), no data is copied. """
+        return self.data[idx]
+
+    def spectrum(self, idx=0):
+        """
+        Return frame <idx> as a 1D array (like winspec does it), the rows
+        of the frame are interleaved. No data is copied if ny == 1.
+        """
+        return self.data[idx].T.ravel()
+
+    @property
+    def accumulations(self):
+        """ Number of accumulations """
+        accumulations = int(self.header["accumulations"])
+        if accumulations == -1:  # does not fit into a short
+            accumulations = int(self.header["NumExpAccums"])
+        return accumulations
+
+    @property
+    def comments(self):
+        """ Comments from the header wrapped into lines of 28 symbols """
+        comments = self.header["comments"].replace("\x00", " ").strip()
+        while comments.find("  ") != -1:
+            comments = comments.replace("  ", " ")
+        comments = "; ".join(comments.splitlines())
+        return "\n".join(textwrap.wrap(comments, width=28))
+
+    @property
+    def fileinfo(self):
+        """ Acquisition parameters and comments as text """
+        hdr = self.header
+        fmt = DATATYPES[int(hdr["dataType"])][1]
+        info = "swVersion         = %s\n" % hdr["swVersion"]
+        info += "headerVersion     = %.3f\n" % hdr["headerVersion"]
+        info += "controllerVersion = %s\n" % hdr["controllerVersion"]
+        info += "date              = %s\n" % hdr["date"]
+        info += "exposure_sec      = %s\n" % float(hdr["exposure_sec"])
+        info += "pimaxGain         = %s\n" % hdr["pimaxGain"]
+        info += "gain              = %s\n" % hdr["gain"]
+        info += "dataType          = %s\n" % hdr["dataType"]
+        info += "analogGain        = %s\n" % hdr["analogGain"]
+        info += "noscan            = %s\n" % hdr["noscan"]
+        info += "detectorTemp_C    = %.1f\n" % hdr["detectorTemp_C"]
+        info += "pimaxUsed         = %s\n" % hdr["pimaxUsed"]
+        info += "nx, ny, nframes   = %i, %i, %i\n" % (self.nx, self.ny,
+                                                      hdr["nframes"])
+        info += "fmtStr            = %i%s\n" % (self.nx * self.ny, fmt)
+        info += "nbytesPerFrame    = %i\n" % (self.nx * self.ny *
+                                               self.dtype.itemsize)
+        info += 'comments          = "%s"\n' % self.comments
+        return info.replace("\x00", "")
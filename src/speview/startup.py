@@ -0,0 +1,84 @@
+"""
+ simple SPE file viewer (Raman spectra) - profiling of the startup
+ license: GNU GPL
+
+ `speviewer --profile-startup` reports how long it takes to import each
+ module and to pass each phase of the startup, until the first frame is
+ drawn. The time spent by the interpreter before running speviewer is
+ not included.
+"""
+
+import time
+import sys
+import __builtin__
+
+
+class StartupProfile(object):
+    """
+    Timing of imports and of startup phases. Call install() as early as
+    possible, phase() at the end of each phase and report() at the end.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.last = self.start
+        self.phases = []   # [ (<name>, <duration>) ]
+        self.imports = []  # [ (<depth>, <module>, <total>, <own time>) ]
+        self.depth = 0
+        self.children = [0.0]  # time of nested imports at each depth
+        self.original_import = None
+
+    def install(self):
+        """ Replace the import function by the timed one """
+        self.original_import = __builtin__.__import__
+        __builtin__.__import__ = self.timed_import
+
+    def uninstall(self):
+        """ Restore the original import function """
+        if self.original_import:
+            __builtin__.__import__ = self.original_import
+            self.original_import = None
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=None,
+                     level=-1):
+        """ Import the module and measure the time if it is loaded now """
+        if name in sys.modules:
+            return self.original_import(name, globals, locals, fromlist,
+                                        level)
+        idx = len(self.imports)
+        self.imports.append(None)  # keep the order of imports
+        self.depth += 1
+        self.children.append(0.0)
+        nmodules = len(sys.modules)
+        start = time.time()
+        try:
+            return self.original_import(name, globals, locals, fromlist,
+                                        level)
+        finally:
+            total = time.time() - start
+            nested = self.children.pop()
+            self.depth -= 1
+            self.children[-1] += total
+            if len(sys.modules) > nmodules:  # something was really loaded
+                if not name:  # from . import <fromlist>
+                    name = "." + ", ".join(fromlist or ())
+                self.imports[idx] = (self.depth, name, total, total - nested)
+
+    def phase(self, name):
+        """ Mark the end of the startup phase <name> """
+        now = time.time()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self, min_time=0.005):
+        """ Print time of phases and of imports longer than <min_time> """
+        self.uninstall()
+        print "Startup phases:"
+        for name, duration in self.phases:
+            print "  %-24s %8.1f ms" % (name, 1000 * duration)
+        print "  %-24s %8.1f ms" % ("total", 1000 * (self.last - self.start))
+        print "Imports (total / own time):"
+        for entry in self.imports:
+            if entry and entry[2] >= min_time:
+                depth, name, total, own = entry
+                print "  %-40s %8.1f ms %8.1f ms" % ("  " * depth + name,
+                                                     1000 * total, 1000 * own)
@@ -0,0 +1,124 @@
+"""
+ simple SPE file viewer (Raman spectra) - stitching of step-and-glue files
+ license: GNU GPL
+
+ A wide spectrum can be acquired as a series of SPE files, each of them
+ covering an adjacent spectral window. Files of such a series are found
+ by the regular expression from the section [stitch] of .speview.conf,
+ e.g.
+     [stitch]
+     pattern = (?P<name>.+)_(?P<step>\d+)\.(SPE|spe)
+ Files with the same <name> are one series, <step> gives their order. A
+ series is shown as one virtual file "<name> (stitched).SPE".
+
+ The x-axis of each window is the Raman shift from the calibration stored
+ in the SPE header, if the spectra are shown in wavenumbers and the laser
+ wavelength is known. WinSpec marks even uncalibrated files as valid,
+ with the polynomial "pixel number + 1", so such an axis is ignored. In
+ all other cases the option
+     step = <shift of x-axis between two windows>
+ gives the x-axis of window <i> as the usual x-axis plus i * step.
+ Overlapping windows are scaled to match the intensity of the previous
+ window and blended linearly within the overlap.
+"""
+
+import re
+import numpy as np
+
+SUFFIX = " (stitched).SPE"
+
+
+def header_axis(spe):
+    """
+    Return Raman shift from the calibration in the header of SPEFile
+    <spe>, or None if there is no real calibration or the laser
+    wavelength is unknown.
+    """
+    hdr = spe.header
+    if not hdr["calib_valid"] or hdr["laser_position"] <= 0:
+        return None
+    coeffs = hdr["polynom_coeff"][:int(hdr["polynom_order"]) + 1]
+    xvals = np.polyval(coeffs[::-1], np.arange(1, spe.nx + 1))
+    if np.allclose(np.diff(xvals), 1.0):  # pixel number, the default
+        return None
+    return 1e7 / hdr["laser_position"] - 1e7 / xvals  # nm -> Raman shift
+
+
+def stitch(windows):
+    """
+    Merge spectral windows, list of (xvals, yvals) with ascending x-axes,
+    into one spectrum. Each window is scaled to match the intensity of
+    the merged spectrum in the overlap (least squares), and the overlap
+    is blended with linear weights. Return (xvals, yvals).
+    """
+    windows = sorted(windows, key=lambda window: window[0][0])
+    xvals, yvals = windows[0]
+    yvals = np.array(yvals, dtype=float)
+    for xnext, ynext in windows[1:]:
+        overlap = (xvals >= xnext[0]) & (xvals <= xnext[-1])
+        ynext = np.asarray(ynext, dtype=float)
+        if overlap.any():
+            known = yvals[overlap]
+            other = np.interp(xvals[overlap], xnext, ynext)
+            norm = np.dot(other, other)
+            scale = np.dot(known, other) / norm if norm > 0 else 1.0
+            weights = np.linspace(1.0, 0.0, len(known))
+            yvals[overlap] = weights * known + (1 - weights) * scale * other
+            ynext = scale * ynext
+        new = xnext > xvals[-1]
+        xvals = np.concatenate((xvals, xnext[new]))
+        yvals = np.concatenate((yvals, ynext[new]))
+    return xvals, yvals
+
+
+class Stitcher(object):
+    """
+    Series of step-and-glue files found in the folder:
+      groups = { <virtual file name> : [<files ordered by step>] }
+    Only series of two or more files are stitched.
+    """
+    def __init__(self, cfg):
+        self.pattern = re.compile(cfg.get("stitch", "pattern") + "$")
+        if cfg.has_option("stitch", "step"):
+            self.step = cfg.getfloat("stitch", "step")
+        else:
+            self.step = None
+        self.series = {}  # { <virtual name> : { <step> : <file> } }
+        self.groups = {}
+
+    def __contains__(self, filename):
+        return filename in self.groups
+
+    def update(self, filenames):
+        """
+        Add files to the series. Return list of virtual files created.
+        """
+        created = []
+        for filename in filenames:
+            match = self.pattern.match(filename)
+            if not match:
+                continue
+            name = match.group("name") + SUFFIX
+            steps = self.series.setdefault(name, {})
+            steps[int(match.group("step"))] = filename
+            if len(steps) > 1:
+                if name not in self.groups:
+                    created.append(name)
+                self.groups[name] = [steps[step] for step in sorted(steps)]
+        return created
+
+    def axis(self, spe, index, xvals, wavenumbers):
+        """
+        Return x-axis of window number <index> of a series. <spe> is the
+        SPEFile, <xvals> is its usual x-axis, in wavenumbers if
+        <wavenumbers> is True (otherwise the header is not used, its axis
+        would be in other units than the other files).
+        """
+        if self.step is not None:
+            return xvals + index * self.step
+        header = header_axis(spe) if wavenumbers else None
+        if header is None:
+            raise ValueError("File '%s' has no Raman shift calibration in "
+                             "the header, set option 'step' in section "
+                             "[stitch]" % spe.filename)
+        return header
@@ -0,0 +1,145 @@
+"""
+ simple SPE file viewer (Raman spectra) - consolidated store of spectra
+ license: GNU GPL
+
+ Processed spectra of all files in a folder are kept in a single binary
+ file, so that thousands of spectra can be opened with one memory-mapped
+ read instead of thousands of small file opens. The store is located in
+ the subfolder STORE_DIR of the data folder and consists of
+   * spectra.bin - float64 matrix, one row per spectrum (frame)
+   * xaxis.npy   - the x-axis shared by all spectra
+   * index.json  - per-file metadata: position of rows in the matrix,
+                   number of frames, mtime/size of the SPE file, processing
+                   settings and acquisition info
+"""
+
+import numpy as np
+import os
+import json
+import threading
+
+STORE_DIR = ".speview-store"
+
+
+class SpectrumStore(object):
+    """
+    Consolidated store of processed spectra of the folder <directory>.
+    New and modified files are added with put(); if the x-axis changes
+    (e.g. after a new calibration), the store is cleared and rebuilt.
+    """
+    def __init__(self, directory="."):
+        self.path = os.path.join(directory, STORE_DIR)
+        self.lock = threading.Lock()
+        self.load()
+
+    def filename(self, name):
+        """ Full name of a file of the store """
+        return os.path.join(self.path, name)
+
+    def load(self):
+        """ Read index and the x-axis, map the matrix of spectra """
+        try:
+            with open(self.filename("index.json")) as fobj:
+                self.index = json.load(fobj)
+            self.xvals = np.load(self.filename("xaxis.npy"))
+        except (IOError, ValueError):
+            self.index = {"npix": None, "rows": 0, "files": {}}
+            self.xvals = None
+        self.data = self.open_data()
+
+    def open_data(self, mode="r"):
+        """ Return memory-mapped matrix of spectra (or None if empty) """
+        if not self.index["rows"]:
+            return None
+        return np.memmap(self.filename("spectra.bin"), dtype="<f8", mode=mode,
+                         shape=(self.index["rows"], self.index["npix"]))
+
+    def __contains__(self, filename):
+        return filename in self.index["files"]
+
+    def files(self):
+        """ Return sorted list of stored files """
+        return sorted(self.index["files"])
+
+    def get(self, filename, frame, stamp, settings):
+        """
+        Return (xvals, yvals) of the frame, or None if the file is not
+        stored, or it has changed, or it was processed with other settings.
+        The spectrum is a view of the memory-mapped matrix.
+        """
+        entry = self.index["files"].get(filename)
+        if (entry is None or stamp is None or
+            tuple(entry["stamp"]) != tuple(stamp) or
+            entry["settings"] != settings or frame >= entry["nframes"]):
+            return None
+        return self.xvals, self.data[entry["row"] + frame]
+
+    def spectra(self):
+        """
+        Return x-axis, matrix of all spectra and a list of (filename,
+        frame) describing its rows. Rows of outdated data are skipped.
+        """
+        rows, labels = [], []
+        for filename in self.files():
+            entry = self.index["files"][filename]
+            for frame in range(entry["nframes"]):
+                rows.append(entry["row"] + frame)
+                labels.append((filename, frame))
+        if rows == range(self.index["rows"]):  # no copy needed
+            return self.xvals, self.data, labels
+        return self.xvals, self.data[rows], labels
+
+    def put(self, filename, stamp, settings, xvals, yvals, info=""):
+        """
+        Store spectra <yvals> (array nframes x npixels) of the file. Rows
+        of a file are overwritten in place if the number of frames is
+        the same, otherwise new rows are appended. Call save() afterwards.
+        """
+        yvals = np.ascontiguousarray(np.atleast_2d(yvals), dtype="<f8")
+        with self.lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            if self.xvals is None or not np.array_equal(xvals, self.xvals):
+                self.clear()
+                self.xvals = np.array(xvals, dtype=float)
+                self.index["npix"] = len(xvals)
+                np.save(self.filename("xaxis.npy"), self.xvals)
+            entry = self.index["files"].get(filename)
+            if entry and entry["nframes"] == len(yvals):
+                self.data = None  # close read-only map before writing
+                data = self.open_data("r+")
+                data[entry["row"]:entry["row"] + len(yvals)] = yvals
+                data.flush()
+                del data
+                row = entry["row"]
+            else:
+                with open(self.filename("spectra.bin"), "ab") as fobj:
+                    # Drop rows appended without save(), e.g. by an
+                    # interrupted batch run, the index does not count them
+                    fobj.truncate(self.index["rows"] * yvals.shape[1] * 8)
+                    fobj.write(yvals.tostring())
+                row = self.index["rows"]
+                self.index["rows"] += len(yvals)
+            self.index["files"][filename] = {"stamp": list(stamp),
+                                             "settings": settings,
+                                             "row": row,
+                                             "nframes": len(yvals),
+                                             "info": info}
+            self.data = self.open_data()
+
+    def save(self):
+        """ Write the index (atomically, through a temporary file) """
+        with self.lock:
+            tmpname = self.filename("index.json.tmp")
+            with open(tmpname, "w") as fobj:
+                json.dump(self.index, fobj)
+            os.rename(tmpname, self.filename("index.json"))
+
+    def clear(self):
+        """ Remove all spectra from the store """
+        self.data = None
+        for name in ("spectra.bin", "xaxis.npy", "index.json"):
+            if os.path.exists(self.filename(name)):
+                os.remove(self.filename(name))
+        self.index = {"npix": None, "rows": 0, "files": {}}
+        self.xvals = None
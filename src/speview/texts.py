@@ -0,0 +1,46 @@
+"""
+ simple SPE file viewer (Raman spectra) - texts of the help
+ license: GNU GPL
+
+ The texts are kept apart from speview.viewer, so that speviewer can parse
+ its arguments (and print --help) without importing matplotlib.
+"""
+
+from speview import __version__
+
+DESC = \
+"""
+short description
+  This application displays binary SPE files containing Raman spectra.
+  It works in a similar fashion to a photoviewing application.
+  Find more info at GitHub:
+        https://github.com/ximeg/speview
+"""
+
+KEYSTROKES = \
+"""
+keystrokes
+  In the main application window you can use the following keystrokes:
+        KEY             FUNCTION
+   <right arrow>  -  show next SPE file
+    <left arrow>  -  show previous SPE file
+           <end>  -  show the most recent SPE file in the folder
+ <up/down arrow>  -  show next/previous spectrum in a file with many spectra
+ <pgup>/<pgdown>  -  jump 10 spectra forward/backward in such a file
+     <space bar>  -  save current file (blue line) to the data buffer
+      'g' or 'G'  -  toggle grid state
+      'a' or 'A'  -  show average of the saved lines
+      'v' or 'V'  -  toggle visibility of current opened file
+             'd'  -  subtract the saved lines from the current line,
+                     press again for ratio and normalized difference
+             'D'  -  remove result of subtraction
+             'l'  -  toggle scale of Y-axis (linear or log)
+             'L'  -  toggle scale of X-axis (linear or log)
+             's'  -  save current figure into a file
+      'i' or 'I'  -  display file info ('I' produces a pop-up dialog)
+            'F5'  -  select the default figure format
+             'P'  -  reload the preprocessing pipeline from .speview.conf
+      'h' or 'H'  -  display help
+
+speview, version %s
+""" % __version__
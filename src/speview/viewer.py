@@ -11,53 +11,39 @@ m.rcParams["savefig.directory"] = None
 
 import pylab as pl
 import numpy as np
-import xcal_raman as xcal
-import winspec
-import PyZenity as pz
 import os
 import sys
 import ConfigParser as cp
-import argparse as ap
-
-from speview import __version__
-
-########################### Texts and constants ###############################
-DESC = \
-"""
-short description
-  This application displays binary SPE files containing Raman spectra.
-  It works in a similar fashion to a photoviewing application.
-  Find more info at GitHub:
-        https://github.com/ximeg/speview
-"""
-
-KEYSTROKES = \
-"""
-keystrokes
-  In the main application window you can use the following keystrokes:
-        KEY             FUNCTION
-   <right arrow>  -  show next SPE file
-    <left arrow>  -  show previous SPE file
-     <space bar>  -  save current file (blue line) to the data buffer
-      'g' or 'G'  -  toggle grid state
-      'v' or 'V'  -  toggle visibility of current opened file
-             'd'  -  subtract a line from the current line
-             'D'  -  remove result of subtraction
-             'l'  -  toggle scale of Y-axis (linear or log)
-             'L'  -  toggle scale of X-axis (linear or log)
-             's'  -  save current figure into a file
-      'i' or 'I'  -  display file info ('I' produces a pop-up dialog)
-            'F5'  -  select the default figure format
-      'h' or 'H'  -  display help
-
-speview, version %s
-""" % __version__
+import threading
+import Queue
+import time
+import struct
+import ctypes
+import ctypes.util
+import bisect
+import warnings
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+from collections import OrderedDict
+import socket
+
+from speview.texts import KEYSTROKES
+from speview.reader import FileReader, file_stamp, is_spe, excluded_files
+from speview.ipc import HandoffServer
+from speview.lod import MinMaxPyramid
+
+################################ Constants ####################################
+# Label of x-axis. Unicode superscripts are used instead of mathtext, whose
+# parser takes a long time to initialize at startup.
+WAVENUMBER = u"Wavenumber, cm\u207b\u00b9"
 ###############################################################################
 
 
 ############################# Helper function #################################
 # mklbl         - make a label for legend, which is not longer than 28 symbols
-# make_spelist  - make a list of all SPE file in the folder
+# make_spelist  - make an index of all SPE files in the folder
+# fits          - check if axis limits can be kept for the new data
+# normalize     - scale spectra to the maximum of 1
 # quiz          - ask user several questions and create config file
 ###############################################################################
 def mklbl(text):
@@ -71,35 +57,41 @@ def mklbl(text):
 
 def make_spelist(cfg, filename):
     """
-    Create a list of all SPE files in working directory, except those
-    present in config. Also the list contains a pointer (active file)
+    Create an index of all SPE files in working directory, except those
+    present in config. The index contains a pointer (active file), which
+    is set to <filename>.
     """
+    excluded = excluded_files(cfg)
+    excluded.discard(filename)
     spelist = [fl for fl in os.listdir(".") if
-               fl.endswith(".SPE") or fl.endswith(".spe")]
-
-    # sort list and get rid of calibration/dark files
-    spelist.sort()
-    try:
-        spelist.remove(cfg.get("wavenum_calibration", "datafile"))
-    except cp.NoOptionError:
-        pass
-    try:
-        spelist.remove(cfg.get("wavenum_calibration", "darkfile"))
-    except cp.NoOptionError:
-        pass
-    try:
-        spelist.remove(cfg.get("general", "darkfile"))
-    except cp.NoOptionError:
-        pass
-
-    # Rotate the circular buffer until the first element is our required file
-    while not spelist[0] == filename:
-        spelist.append(spelist.pop(0))
-    return spelist
+               is_spe(fl) and fl not in excluded]
+    return FileIndex(spelist, filename)
+
+
+def fits(inner, outer):
+    """
+    Check if the axis limits <inner> lie within <outer> and cover at least
+    80% of them, i.e. if the plot can be kept with limits <outer>.
+    """
+    return (outer[0] <= inner[0] and inner[1] <= outer[1] and
+            inner[1] - inner[0] >= 0.8 * (outer[1] - outer[0]))
+
+
+def normalize(spectra):
+    """
+    Scale spectra (rows of the array) to the maximum of 1. Missing points
+    (NaN) are ignored.
+    """
+    with warnings.catch_warnings():  # rows without data stay NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        scale = np.nanmax(np.abs(spectra), axis=-1)
+    scale = np.where((scale == 0) | np.isnan(scale), 1.0, scale)
+    return spectra / np.expand_dims(scale, -1)
 
 
 def quiz(cfg, filename):
     """ Ask user several questions and create config for this directory. """
+    import PyZenity as pz  # dialogs are imported only when needed
     ans = pz.Question("Would you like to use\nwavenumber calibration?")
     spelist = [name for name in os.listdir(".") if
                name.endswith(".SPE") or name.endswith(".spe")]
@@ -156,205 +148,613 @@ def quiz(cfg, filename):
 
 
 ################################### Classes ###################################
-# LineColors  - management of colors for lines
-# FileReader  - reading of SPE files and data calibration
-# DataItem    - structure to save the data from files
-# DataSet     - a set of DataItem's with methods to manage the data
-# Window      - a Matplotlib figure with key press handlers
+# LineStyles    - management of colors and styles of saved lines
+# FileIndex     - sorted list of SPE files with a pointer to the active one
+# Prefetcher    - background threads reading neighbouring files in advance
+# DirectoryWatcher - detection of new SPE files in the working directory
+# DataItem      - structure to save the data from files
+# DataSet       - a set of DataItem's with methods to manage the data
+# Window        - a Matplotlib figure with key press handlers
 ###############################################################################
-class LineColors(object):
-    """ Management of line colors on the plot """
-    def __init__(self):
-        self.seq = ["#800000", "r", "g", "m", "k", "y"]  # Sequence of colors
-        self.status = [0] * len(self.seq)  # 1 if color is used, 0 otherwise
+class LineStyles(object):
+    """
+    Management of styles of the saved lines on the plot. Style number <i>
+    is a color of the colormap <cmap> combined with a line style, the
+    colors are used first. A style is taken from the list of freed styles
+    if possible, otherwise the next new style is used, so that use() and
+    free() take O(1) time and the number of lines is not limited.
+    """
+    linestyles = ["-", "--", "-.", ":"]
+
+    def __init__(self, cmap="tab10", skip=(0,)):
+        cmap = m.cm.get_cmap(cmap)
+        self.colors = [m.colors.to_hex(cmap(i)) for i in range(cmap.N)
+                       if i not in skip]  # skip colors similar to default
+        self.freed = []  # styles which can be used again
+        self.next = 0    # the first style which was never used
         self.default = "#0000b0"
         self.diff    = "#008000"
 
     def use(self):
-        """ Use the next available color. """
-        if 0 in self.status:
-            for i, color in enumerate(self.seq):
-                if not self.status[i]:
-                    self.status[i] = 1
-                    return color
-        else:
-            print "All colors are used, cannot add one more line!"
-            return False
-
-    def free(self, key):
-        """ Mark color given by <key> as unused """
-        idx = self.seq.index(key)
-        self.status[idx] = 0
-        print "Color '%s' is now free" % key
+        """ Return number of a free style. """
+        if self.freed:
+            return self.freed.pop()
+        self.next += 1
+        return self.next - 1
+
+    def free(self, style):
+        """ Mark style <style> as unused """
+        self.freed.append(style)
+
+    def style(self, style):
+        """ Return (color, linestyle) of style number <style> """
+        ncolors = len(self.colors)
+        return (self.colors[style % ncolors],
+                self.linestyles[(style // ncolors) % len(self.linestyles)])
 
     def __repr__(self):
-        desc = ""
-        for i in range(len(self.seq)):
-            desc += "%s = %i\n" % (self.seq[i], self.status[i])
-        return desc
-
-line_colors = LineColors()
-
-
-class FileReader(object):
-    """ Reading of SPE files and calibration of data """
-    def __init__(self, cfg):
-        """ Check if the calibration is required and perform it. """
-        self.cfg = cfg
-        self.calibrated = False
-        if cfg.get("general", "wavenum_calibration") == "yes":
-            # check if calibration coefficients are available
-            if os.path.exists("xcal_coeffs.csv"):
-                self.cal_f = lambda x: \
-                        np.polyval(np.loadtxt("xcal_coeffs.csv"), x)
-            else:
-                material = cfg.get("wavenum_calibration", "material")
-                xcalfile = cfg.get("wavenum_calibration", "datafile")
-                darkfile = cfg.get("wavenum_calibration", "darkfile")
-                shift = cfg.getint("wavenum_calibration", "shift")
-                self.cal_f, coeffs = \
-                        xcal.calibrate_spe(xcalfile, darkfile,
-                                           material=material,
-                                           figure=pl.figure(), shift=shift)
-                pl.savefig("calibration_report-" + material + ".pdf")
-                pl.close(pl.gcf())
-                np.savetxt("xcal_coeffs.csv", coeffs)
-            self.calibrated = True
-        else:
-            self.cal_f = lambda x: np.polyval([1, 0], x)
-
-    def read_spe(self, filename):
-        """ Read data from SPE file and apply calibration function on it. """
-        spec = winspec.Spectrum(filename)
-        if self.cfg.get("general", "use_dark") == "yes":
-            if os.path.exists(filename[:-3] + "dark.SPE"):  # overrides config
-                spec.background_correct(filename[:-3] + "dark.SPE")
-            elif os.path.exists(filename[:-3] + "dark.spe"):
-                spec.background_correct(filename[:-3] + "dark.spe")
-            else:
-                spec.background_correct(self.cfg.get("general", "darkfile"))
+        return "%i styles used, %i of them are free" % (self.next,
+                                                        len(self.freed))
 
-        return self.cal_f(spec.wavelen), spec.lum
+line_styles = LineStyles()
 
-    def read_info(self, filename):
-        """ Read acquisition information and comments from the file. """
-        spec = winspec.Spectrum(filename)
-        return spec.fileinfo
 
-    def read_other_data_format(self, filename):
-        """ TODO Use data from some other file. """
-        print self.calibrated
-        print "read_other_data_format({}) - NOT IMPLEMENTED".format(filename)
-        raise NotImplementedError
+class FileIndex(object):
+    """
+    Sorted list of SPE files with a cursor pointing to the active file:
+      files = [<filename>, ...]
+      position = { <filename> : <index in files> }
+    Moving the cursor and jumping to a file by its name take O(1) time.
+    """
+    def __init__(self, files, current=None):
+        self.files = sorted(files)
+        self.position = dict((name, i) for i, name in enumerate(self.files))
+        self.cursor = 0
+        if current is not None:
+            self.jump(current)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __contains__(self, filename):
+        return filename in self.position
+
+    @property
+    def current(self):
+        """ Name of the active file """
+        return self.files[self.cursor]
+
+    def neighbour(self, step):
+        """ Name of the file <step> positions away from the active one """
+        return self.files[(self.cursor + step) % len(self.files)]
+
+    def forward(self):
+        """ Make the next file active (the list is circular) """
+        self.cursor = (self.cursor + 1) % len(self.files)
+        return self.current
+
+    def backward(self):
+        """ Make the previous file active """
+        self.cursor = (self.cursor - 1) % len(self.files)
+        return self.current
+
+    def jump(self, filename):
+        """ Make the file <filename> active """
+        self.cursor = self.position[filename]
+        return self.current
+
+    def insert(self, filename):
+        """ Add a new file keeping the list sorted, keep the cursor """
+        if filename in self.position:
+            return
+        idx = bisect.bisect(self.files, filename)
+        self.files.insert(idx, filename)
+        for i in range(idx, len(self.files)):
+            self.position[self.files[i]] = i
+        if idx <= self.cursor and len(self.files) > 1:
+            self.cursor += 1
+
+
+class Prefetcher(object):
+    """
+    Pool of background threads, which read (decode, dark-correct and
+    calibrate) spectra into the cache of <reader> before the user asks
+    for them. Only the most recent request is served, older pending jobs
+    are dropped.
+    """
+    def __init__(self, reader, nthreads=2):
+        self.reader = reader
+        self.queue = Queue.Queue()
+        self.generation = 0
+        for i in range(nthreads):
+            thread = threading.Thread(target=self.work, name="prefetch-%i" % i)
+            thread.daemon = True
+            thread.start()
+
+    def request(self, jobs):
+        """ Replace pending jobs by a list of (filename, frame) to be read """
+        self.generation += 1
+        for job in jobs:
+            self.queue.put((self.generation, job))
+
+    def work(self):
+        """ Main loop of a worker thread """
+        while True:
+            generation, (filename, frame) = self.queue.get()
+            if generation != self.generation:
+                continue  # outdated job, the user went somewhere else
+            try:
+                self.reader.read_spe(filename, frame)
+            except Exception as err:  # e.g. file is still being written
+                print "Prefetching of '%s' failed: %s" % (filename, err)
+
+
+class DirectoryWatcher(object):
+    """
+    Detection of new SPE files in the directory <path>. Linux inotify is
+    used if it is available, otherwise the directory is polled every
+    <interval> seconds. The watching is done in a background thread, which
+    puts names of new files into a queue. Use poll() to get them.
+    """
+    IN_CLOSE_WRITE = 0x08
+    IN_MOVED_TO = 0x80
+
+    def __init__(self, path=".", interval=0.5):
+        self.path = path
+        self.interval = interval
+        self.queue = Queue.Queue()
+        self.known = set(name for name in os.listdir(path) if is_spe(name))
+        self.fd = self.init_inotify()
+        if self.fd is not None:
+            target = self.watch_inotify
+        else:
+            target = self.watch_polling
+        thread = threading.Thread(target=target, name="watcher")
+        thread.daemon = True
+        thread.start()
+
+    def init_inotify(self):
+        """ Return inotify file descriptor or None if it is unavailable """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init()
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, self.path,
+                                  self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def watch_inotify(self):
+        """ Read inotify events, report files when they are written """
+        while True:
+            buf = os.read(self.fd, 65536)
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = struct.unpack_from("iIII", buf, pos)
+                pos += 16
+                self.found(buf[pos:pos + length].rstrip("\0"))
+                pos += length
+
+    def watch_polling(self):
+        """ Rescan the directory when it changes, report complete files """
+        stamp = file_stamp(self.path)
+        pending = {}  # { <new file> : <stamp> }, waiting until size is stable
+        while True:
+            time.sleep(self.interval)
+            new_stamp = file_stamp(self.path)
+            if new_stamp != stamp:
+                stamp = new_stamp
+                for name in os.listdir(self.path):
+                    if is_spe(name) and name not in self.known:
+                        pending.setdefault(name, None)
+            for name in pending.keys():
+                fstamp = file_stamp(os.path.join(self.path, name))
+                if fstamp is None:  # the file was removed
+                    del pending[name]
+                elif fstamp == pending[name]:
+                    del pending[name]
+                    self.found(name)
+                else:
+                    pending[name] = fstamp
+
+    def found(self, name):
+        """ Report a new SPE file """
+        if is_spe(name) and name not in self.known:
+            self.known.add(name)
+            self.queue.put(name)
+
+    def poll(self):
+        """ Return list of new files found since the last call """
+        names = []
+        while True:
+            try:
+                names.append(self.queue.get_nowait())
+            except Queue.Empty:
+                return names
 
 
 class DataItem(object):
     """
-    DataItem is a container to store data from one single file. It contains
-    the following attributes:
+    DataItem describes a spectrum stored in DataSet. It contains the
+    following attributes:
         * self.filename - name of the SPE file
         * self.shape - number of spectra in the file
-        * self.color - color for line on the plot
-        * self.xvals - numpy array of x-values
-        * self.yvals - numpy array of y-values
+        * self.frame - which spectrum (frame) of the file is stored
+        * self.style - number of the line style, see LineStyles
+        * self.row - row of the DataSet matrix containing the spectrum
+        * self.line - line representing the spectrum in the legend,
+                      created only if it is shown (see legend_line)
+        * self.lod - MinMaxPyramid used to plot the spectrum
     """
-    def __init__(self, filename):
+    __slots__ = ("filename", "shape", "frame", "style", "row", "line", "lod")
+
+    def __init__(self, filename, frame, shape, style, row):
         self.filename = filename
-        self.shape = 0
-        self.color = None
-        self.xvals = []
-        self.yvals = []
+        self.shape = shape
+        self.frame = frame
+        self.style = style
+        self.row = row
+        self.line = None
+        self.lod = None
 
     def __repr__(self):
-        if self.shape:
-            return ("\nstatus=%i color=%s X=%20.20s Y=%20.20s\n" %
-                    (self.shape, repr(self.color),
-                     repr(self.xvals), repr(self.yvals)))
-        else:
-            return "empty!\n"
+        return ("\nstatus=%i style=%i row=%i\n" %
+                (self.shape, self.style, self.row))
+
+    def label(self):
+        """ Label for legend, contains the frame number if necessary """
+        if self.shape > 1:
+            return "%s [%i]" % (mklbl(self.filename), self.frame + 1)
+        return mklbl(self.filename)
 
-    def reset(self):
-        """ Mark data item as unused and remove the data. """
-        self.__init__(self.filename)
+    def legend_line(self):
+        """ Return the line representing the spectrum in the legend """
+        if self.line is None:
+            color, linestyle = line_styles.style(self.style)
+            self.line = Line2D([], [], color=color, linestyle=linestyle,
+                               lw=1.0, label=self.label())
+        return self.line
 
 
 class DataSet(object):
     """
-    This class contains a list of SPE files and the corresponding data.
+    This class contains the spectra saved by user (held lines).
 
     Data format
     ---
-      data = { <filename> : <item> }
-    where <item> is an instance of class DataItem
+      data = OrderedDict( <filename> : <item> )
+    where <item> is an instance of class DataItem. Only the stored files
+    are present, in the order they were added. The stored spectra are
+    rows of the matrix <self.matrix> with the common x-axis <self.xvals>.
+    The matrix is allocated for several spectra at once and grows twice
+    when it is full; rows of removed spectra are reused. All stored spectra
+    are drawn as a single LineCollection, reduced to the visible range
+    and plot width <self.view> (see speview.lod).
 
     Methods
     ---
     You can place your data from the file <filename> in the following way:
       dataset[<filename>] = xvals, yvals
-    The corresponding DataItem will automatically get next free line color
+    or, if the file contains several spectra (frames),
+      dataset[<filename>] = xvals, yvals, frame, nframes
+    The corresponding DataItem will automatically get next free line style.
+    A spectrum with another x-axis is interpolated onto the common one,
+    points outside of its range are missing (NaN).
+
+    Get the item (or None if the file is not stored):
+      dataset.get(<filename>)
 
     Remove item from dataset:
       dataset.remove(<filename>)
 
     Plot all lines:
-      dataset.plot()
+      dataset.plot(axes)
+
+    Operations on all stored spectra at once:
+      dataset.spectra(), dataset.mean(), dataset.normalized()
     """
-    def __init__(self, files):
-        self.data = dict((key, DataItem(key)) for key in files)
+    legend_size = 16  # the legend shows at most so many stored lines
+
+    def __init__(self):
+        self.data = OrderedDict()
+        self.xvals = None
+        self.matrix = None
+        self.free_rows = []
+        self.collection = None
+        self.changed = False  # the collection must be updated
+        self.version = 0  # increased when the stored data change
+        self.limits = None  # (min, max) of stored spectra
+        self.view = None  # (xmin, xmax, width in pixels) of the plot
+        self.more = Line2D([], [], linestyle="None")  # legend: "... N more"
 
     def __setitem__(self, key, item):
-        if self.data[key].shape == 0:
-            self.data[key].xvals, self.data[key].yvals = item
-            self.data[key].color = line_colors.use()
-            if self.data[key].color:
-                self.data[key].shape = 1
+        if key not in self.data:
+            if len(item) == 2:
+                item = tuple(item) + (0, 1)
+            row = self.put(*item[:2])
+            self.data[key] = DataItem(key, item[2], item[3], line_styles.use(),
+                                      row)
+            self.data[key].lod = MinMaxPyramid(self.xvals, self.matrix[row])
+            self.changed = True
+            self.version += 1
         else:
             print "File '%.35s' is already opened, nothing to do" % key
 
     def __getitem__(self, key):
         return self.data[key]
 
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        """ Return DataItem of the file or None if it is not stored """
+        return self.data.get(key)
+
+    def put(self, xvals, yvals):
+        """ Write the spectrum into a free row of the matrix. Return row. """
+        if not self.data:  # the first spectrum defines the x-axis
+            self.xvals = np.array(xvals, dtype=float)
+            if self.matrix is None or self.matrix.shape[1] != len(xvals):
+                self.matrix = np.empty((8, len(xvals)))
+                self.free_rows = range(8)
+        elif not np.array_equal(xvals, self.xvals):
+            yvals = np.interp(self.xvals, xvals, yvals, left=np.nan,
+                              right=np.nan)
+        if not self.free_rows:
+            size = len(self.matrix)
+            self.matrix = np.vstack((self.matrix, np.empty_like(self.matrix)))
+            self.free_rows = range(size, 2 * size)
+            self.update_pyramids()  # the old matrix is not used any more
+        row = self.free_rows.pop()
+        self.matrix[row] = yvals
+        return row
+
+    def yvals(self, key):
+        """ Return the stored spectrum of the file (on the common x-axis) """
+        return self.matrix[self.data[key].row]
+
+    def set_axis(self, xvals):
+        """ Replace the common x-axis, e.g. when the calibration changes """
+        self.xvals = np.array(xvals, dtype=float)
+        self.update_pyramids()
+        self.changed = True
+        self.version += 1
+
+    def update_pyramids(self):
+        """ Create the pyramids of all stored spectra again """
+        for item in self.data.itervalues():
+            item.lod = MinMaxPyramid(self.xvals, self.matrix[item.row])
+
+    def set_view(self, view):
+        """ Plot the spectra for view (xmin, xmax, width in pixels) """
+        if view != self.view:
+            self.view = view
+            if self.data and self.collection:
+                self.update()
+
+    def rows(self, keys=None):
+        """ Return indices of matrix rows of <keys> (default is all files) """
+        if keys is None:
+            keys = self.data
+        return np.array([self.data[key].row for key in keys], dtype=int)
+
+    def mean(self):
+        """ Return average of the stored spectra, ignoring missing points """
+        with warnings.catch_warnings():  # points without data stay NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return np.nanmean(self.matrix[self.rows()], axis=0)
+
+    def spectra(self, keys=None):
+        """ Return the stored spectra of <keys> (default is all files) """
+        return self.matrix[self.rows(keys)]
+
+    def normalized(self, keys=None):
+        """ Return the stored spectra scaled to the maximum of 1 """
+        return normalize(self.spectra(keys))
+
+    def resample(self, xvals, yvals):
+        """
+        Return the spectrum (xvals, yvals) on the common x-axis, NaN outside
+        of its range.
+        """
+        if np.array_equal(xvals, self.xvals):
+            return yvals
+        return np.interp(self.xvals, xvals, yvals, left=np.nan, right=np.nan)
+
     def __repr__(self):
         return repr(self.data)
 
     def remove(self, key):
-        """ Delete data from DataItem and mark associated color as unused. """
-        if self.data[key].shape:
-            line_colors.free(self.data[key].color)
-            self.data[key].reset()
+        """ Delete the stored data and mark associated color as unused. """
+        item = self.data.pop(key, None)
+        if item:
+            line_styles.free(item.style)
+            self.free_rows.append(item.row)
+            self.changed = True
+            self.version += 1
 
     def get_lines(self):
         """ Return names of files being stored. """
-        keys = []
-        for key in self.data:
-            if self.data[key].shape:
-                keys.append(key)
-        return keys
+        return list(self.data)
+
+    def ylim(self):
+        """ Return (min, max) of the stored spectra or None (no data) """
+        if self.changed:
+            self.update()
+        return self.limits
+
+    def update(self):
+        """ Put the stored spectra into the collection """
+        if self.data:
+            spectra = self.matrix[self.rows()]
+            if self.view:
+                self.collection.set_segments(
+                    [np.column_stack(item.lod.view(*self.view))
+                     for item in self.data.itervalues()])
+            else:
+                xvals = np.broadcast_to(self.xvals, spectra.shape)
+                self.collection.set_segments(np.dstack((xvals, spectra)))
+            styles = [line_styles.style(item.style)
+                      for item in self.data.itervalues()]
+            self.collection.set_color([color for color, ls in styles])
+            self.collection.set_linestyle([ls for color, ls in styles])
+            finite = spectra[np.isfinite(spectra)]
+            if finite.size:
+                self.limits = finite.min(), finite.max()
+            else:
+                self.limits = None
+        else:
+            self.collection.set_segments([])
+            self.limits = None
+        self.changed = False
 
     def plot(self, axes):
-        """ Draw the data stored in DataSet on the current axes. """
-        for key in self.data:
-            if self.data[key].shape:
-                axes.plot(self.data[key].xvals,
-                          self.data[key].yvals,
-                          self.data[key].color, lw=1.0, label=mklbl(key))
+        """
+        Draw the data stored in DataSet on the axes. The collection of
+        lines is created only once and updated when the stored data change.
+        Return list of lines in the order they should appear in a legend.
+        """
+        if self.collection is None:
+            self.collection = LineCollection([], linewidths=1.0)
+            axes.add_collection(self.collection, autolim=False)
+        if self.changed:
+            self.update()
+        items = self.data.values()
+        if len(items) > self.legend_size:  # the legend would be too long
+            self.more.set_label("... %i more" %
+                                (len(items) - self.legend_size + 1))
+            return [item.legend_line()
+                    for item in items[:self.legend_size - 1]] + [self.more]
+        return [item.legend_line() for item in items]
+
+
+class DiffEngine(object):
+    """
+    Comparison of the current spectrum with all spectra stored in <dataset>
+    at once. The current spectrum is resampled onto the common x-axis of
+    the dataset if necessary, the result is NaN where one of the spectra
+    has no data. Modes of comparison (see MODES):
+      * difference - current minus stored spectrum
+      * ratio      - current divided by stored spectrum, only where the
+                     stored spectrum exceeds 1% of its maximum
+      * normalized - difference of the spectra scaled to the maximum of 1
+    The result is kept until the current spectrum, the stored spectra or
+    the mode change, together with the pyramids used to plot its rows
+    (see segments).
+    """
+    MODES = ("difference", "ratio", "normalized")
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.mode = self.MODES[0]
+        self.key = None
+        self.result = None
+        self.pyramids = []  # MinMaxPyramid of each row of the result
+
+    def next_mode(self):
+        """ Switch to the next mode of comparison """
+        self.mode = self.MODES[(self.MODES.index(self.mode) + 1) %
+                               len(self.MODES)]
+
+    def compute(self, filename, xvals, yvals):
+        """
+        Compare spectrum (xvals, yvals) of the file <filename> with the
+        stored spectra of other files. Return tuple (x-axis, array with
+        one result per row, list of the stored files).
+        """
+        key = (filename, self.dataset.version, self.mode)
+        if key == self.key and self.result[0] is yvals:
+            return self.result[1:]
+        refs = [name for name in self.dataset.get_lines() if name != filename]
+        if not refs:
+            result = np.empty((0, len(xvals)))
+            xdiff = xvals
+        else:
+            xdiff = self.dataset.xvals
+            current = self.dataset.resample(xvals, yvals)
+            if self.mode == "difference":
+                result = current - self.dataset.spectra(refs)
+            elif self.mode == "ratio":
+                spectra = self.dataset.spectra(refs)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    noise = np.abs(spectra) < 0.01 * np.nanmax(
+                        np.abs(spectra), axis=1)[:, np.newaxis]
+                    result = current / spectra
+                result[noise | ~np.isfinite(result)] = np.nan
+            else:
+                result = normalize(current) - self.dataset.normalized(refs)
+        self.key = key
+        self.result = (yvals, xdiff, result, refs)
+        self.pyramids = [MinMaxPyramid(xdiff, row) for row in result]
+        return self.result[1:]
+
+    def segments(self, xmin, xmax, width):
+        """
+        Return rows of the last result reduced to the view (see
+        speview.lod), as segments of a LineCollection.
+        """
+        return [np.column_stack(pyramid.view(xmin, xmax, width))
+                for pyramid in self.pyramids]
 
 
 class Window(object):
     """ A matplotlib figure used to display plots """
-    def __init__(self, cfg, filename):
-        self.spelist = make_spelist(cfg, filename)
+    def __init__(self, cfg, filename, profile=None):
+        """
+        Show the file <filename>. If <profile> (StartupProfile) is given,
+        the startup phases are timed and reported after the first frame.
+        """
+        self.profile = profile
+        self.files = make_spelist(cfg, filename)
 
         # Create a data container and a file reader instance
-        self.dataset = DataSet(self.spelist)
-        self.reader = FileReader(cfg)
+        self.dataset = DataSet()
+        self.reader = FileReader(cfg, background=True)
+        if self.reader.stitcher:  # series of windows as virtual files
+            for name in self.reader.stitcher.update(list(self.files)):
+                self.files.insert(name)
+        if profile:
+            profile.phase("file list, reader")
+
+        # Read the neighbouring files in background (0 turns it off)
+        if cfg.has_option("general", "prefetch"):
+            self.prefetch_size = cfg.getint("general", "prefetch")
+        else:
+            self.prefetch_size = 3
+        if self.prefetch_size > 0:
+            self.prefetcher = Prefetcher(self.reader)
+        else:
+            self.prefetcher = None
+        self.direction = 1  # +1 if user goes forward, -1 otherwise
+        self.frame = 0  # active spectrum in a file with several spectra
+        self.nframes = 1
 
         # Create a figure and show it (start the event loop)
         self.figure = pl.figure()
         self.axes = self.figure.gca()
+        if profile:
+            profile.phase("figure")
+
+        self.axes.margins(0.0, 0.05)  # 5% vertical margins
+        self.axes.yaxis.get_major_formatter().set_powerlimits((0, 4))
+        self.axes.set_ylabel("Counts")
 
         self.axes_diff = None
-        self.diffdata = None
+        self.diff_engine = DiffEngine(self.dataset)
+
+        # Long spectra are plotted with reduced level of detail
+        self.current = None  # filename, frame, x and y of the current line
+        self.pyramids = OrderedDict()  # { (<file>, <frame>) : (y, pyramid) }
         self.visible = True
         self.help = False
         self.grid = True
@@ -364,10 +764,95 @@ class Window(object):
                        "edgecolor": "black",
                        "boxstyle": "round, pad=1"}
 
+        # Persistent artists, draw() only updates them
+        self.line, = self.axes.plot([], [], line_styles.default, lw=1.25)
+        self.zero = self.axes.axhline(0, color="k", linestyle="--", lw=.7,
+                                      alpha=.5)
+        self.show_mean = False
+        self.mean_line, = self.axes.plot([], [], "k", linestyle="-.", lw=1.25,
+                                         visible=False)
+        self.legend = None
+        self.legend_key = None  # lines shown in the legend
+        self.help_text = \
+          self.figure.text(0.05, 0.5, KEYSTROKES, fontsize="medium",
+                           ha="left", va="center", family="monospace",
+                           bbox=self.boxprops, visible=False)
+        self.info_text = \
+          self.axes.text(0.0, 0.0, "", fontsize="medium", ha="left",
+                         va="bottom", family="monospace",
+                         bbox=self.boxprops, visible=False)
+        self.diff_lines = None
+        self.diff_zero = None
+        self.diff_legend = None
+        self.diff_key = None  # stored files and mode shown in the diff legend
+
+        # In blit mode the static part of the figure is saved as a bitmap
+        # and only the artists changing with the current file are redrawn
+        self.blit = cfg.has_option("general", "blit") and \
+                    cfg.getboolean("general", "blit")
+        self.background = None
+        self.static = None  # state of the figure saved in the background
+        for artist in (self.line, self.axes.title, self.info_text):
+            artist.set_animated(self.blit)
+
         self.canvas = self.figure.canvas
         self.canvas.mpl_connect("key_press_event", self.key_event)
+        self.canvas.mpl_connect("resize_event", self.update_lod)
+        self.axes.callbacks.connect("xlim_changed", self.update_lod)
+        if self.blit:
+            self.canvas.mpl_connect("draw_event", self.on_draw)
+
+        # Watch the directory for new files (e.g. during measurements)
+        self.excluded = excluded_files(cfg)
+        self.newest = None  # the most recent acquisition
+        self.follow = cfg.has_option("general", "follow") and \
+                      cfg.getboolean("general", "follow")
+        if not cfg.has_option("general", "watch") or \
+           cfg.getboolean("general", "watch"):
+            self.watcher = DirectoryWatcher(".")
+            self.timer = self.canvas.new_timer(interval=200)
+            self.timer.add_callback(self.check_new_files)
+            self.timer.start()
+        else:
+            self.watcher = None
+
+        # Single-instance mode: files of this folder opened by speviewer
+        # later are shown in this window (see speview.ipc)
+        self.server = None
+        if not cfg.has_option("general", "single_instance") or \
+           cfg.getboolean("general", "single_instance"):
+            try:
+                self.server = HandoffServer(".")
+            except socket.error as err:
+                print "Single-instance mode is off: %s" % err
+            else:
+                self.handoff_timer = self.canvas.new_timer(interval=40)
+                self.handoff_timer.add_callback(self.check_handoff)
+                self.handoff_timer.start()
+
+        # Spectra have the pixel axis until the coefficients are written
+        if self.reader.calibration.frozen:
+            print "Calibration is running in background..."
+            self.calibration_timer = self.canvas.new_timer(interval=250)
+            self.calibration_timer.add_callback(self.check_calibration)
+            self.calibration_timer.start()
         self.draw()
-        pl.show()
+        if profile:
+            profile.phase("data, artists")
+            self.profile_cid = self.canvas.mpl_connect("draw_event",
+                                                       self.first_frame)
+        self.prefetch()
+        try:
+            pl.show()
+        finally:
+            if self.server:
+                self.server.close()
+
+    def first_frame(self, event):
+        """ Report startup time when the figure is drawn for the first time """
+        self.canvas.mpl_disconnect(self.profile_cid)
+        self.profile.phase("first frame")
+        self.profile.report()
 
     def key_event(self, event):
         """ Check which key was pressed and call the corresp. function. """
@@ -375,11 +860,24 @@ class Window(object):
             self.go_next()
         if event.key == "left":
             self.go_prev()
+        if event.key == "end":
+            self.go_newest()
+        if event.key == "up":
+            self.go_frame(1)
+        if event.key == "down":
+            self.go_frame(-1)
+        if event.key == "pageup":
+            self.go_frame(10)
+        if event.key == "pagedown":
+            self.go_frame(-10)
         if event.key == " ":  # Space bar is pressed
             self.toggle()
         if event.key == "g" or event.key == "G":
             self.grid = not self.grid
             self.draw()
+        if event.key == "a" or event.key == "A":
+            self.show_mean = not self.show_mean
+            self.draw()
         if event.key == "d":
             self.diff()
         if event.key == "D":
@@ -388,18 +886,18 @@ class Window(object):
             self.visible = not self.visible
             self.draw()
         if event.key == "h" or event.key == "H":
-            if not self.help:
-                self.help = True
-            else:
-                self.help.set_visible(False)
-                self.help = False
+            self.help = not self.help
             self.draw()
         if event.key == "i":
             self.show_info = not self.show_info
             self.draw()
         if event.key == "I":
-            pz.InfoMessage(self.reader.read_info(self.spelist[0]))
+            import PyZenity as pz
+            pz.InfoMessage(self.reader.read_info(self.files.current))
+        if event.key == "P":
+            self.reload_pipeline()
         if event.key == "f5":
+            import PyZenity as pz
             content = [(fmt, desc) for fmt, desc in
                        self.canvas.get_supported_filetypes().iteritems()]
             ans = pz.List(("Formats", "Descr"),
@@ -412,138 +910,389 @@ class Window(object):
 
 
     def draw(self):
-        """ Redraw the plot. First draw stored data, then the current file. """
-        if self.axes_diff:
-            self.axes_diff.cla()
-        self.axes.cla()
-        pl.sca(self.axes)
-        # Plot stored data
-        self.dataset.plot(self.axes)
-        filename = self.spelist[0]
-
-        # Plot current spectrum
-        x, y = self.reader.read_spe(filename)
+        """
+        Update the plot. The lines and text boxes are created only once,
+        here we just replace their data and change their visibility.
+        """
+        filename = self.files.current
+        self.nframes = self.reader.frames(filename)
+        x, y = self.reader.read_spe(filename, self.frame)
+
+        # Stored data and the current spectrum
+        lines = self.dataset.plot(self.axes)
+        self.current = (filename, self.frame, x, y)
+        if self.nframes > 1:
+            self.line.set_label("%s [%i]" % (mklbl(filename), self.frame + 1))
+        else:
+            self.line.set_label(mklbl(filename))
+        self.line.set_visible(self.visible)
         if self.visible:
-            self.axes.plot(x, y, line_colors.default, lw=1.25,
-                           label=mklbl(filename))
-
-        # Plot difference (if any)
-        if self.diffdata and self.axes_diff:
-            y, label = self.diffdata
-            self.axes_diff.plot(x, y, line_colors.diff, linestyle="-",
-                                lw=0.8, label=label, alpha=0.7)
-            legend_diff = self.axes_diff.legend(loc="center right",
-                                                fontsize="small",
-                                                fancybox=True,
-                                                frameon=True, framealpha=0.6)
-            legend_diff.draggable(True)
-            legend_diff.set_title("Difference")
-            self.axes_diff.set_ylabel("Difference in counts",
-                                      color=line_colors.diff)
-            self.axes_diff.hlines(0, min(x), max(x), color=line_colors.diff,
-                                  linestyles="--", lw=.75, alpha=.5)
-            for tl in self.axes_diff.get_yticklabels():
-                tl.set_color(line_colors.diff)
-        pl.sca(self.axes)
+            lines.append(self.line)
+
+        # Average of stored spectra
+        nlines = len(self.dataset)
+        self.mean_line.set_visible(self.show_mean and nlines > 1)
+        if self.mean_line.get_visible():
+            self.mean_line.set_data(self.dataset.xvals, self.dataset.mean())
+            self.mean_line.set_label("average of %i" % nlines)
+            lines.append(self.mean_line)
+
+        # Difference (if any)
+        diff_ylim = None
+        if self.axes_diff and self.axes_diff.get_visible():
+            diff_ylim = self.axes_diff.get_ylim()
+            self.draw_diff(filename, x, y)
 
         # change figure title and plot params
         self.canvas.set_window_title(filename)
-
-        # Formatting - zero level, limits of axes
-        self.axes.set_xlim(min(x), max(x))
-        pl.margins(0.0, 0.05)  # 5% vertical margins
-        self.axes.yaxis.get_major_formatter().set_powerlimits((0, 4))
-        self.axes.yaxis.get_major_formatter().set_powerlimits((0, 4))
-
-        # Formatting - labels and title
-        pl.ylabel("Counts")
-        pl.title(filename)
+        if self.nframes > 1:
+            self.axes.set_title("%s, frame %i of %i" %
+                                (filename, self.frame + 1, self.nframes))
+        else:
+            self.axes.set_title(filename)
         if self.reader.calibrated:
-            pl.xlabel("Wavenumber, cm$^{-1}$")
+            self.axes.set_xlabel(WAVENUMBER)
         else:
-            pl.xlabel("pixel number")
-
-        # Formatting - legend
-        if self.visible or len(self.dataset.get_lines()):
-            pl.hlines(0, min(x), max(x), "k", linestyles="--", lw=.7, alpha=.5)
-            legend = pl.legend(loc="upper right", fontsize="small",
-                               fancybox=True, frameon=True, framealpha=0.6)
-            legend.draggable(True)
-            if len(legend.get_texts()) > 1:
-                legend.set_title("Opened files")
-            else:
-                legend.set_title("Opened file")
-            self.axes.yaxis.set_visible(True)
+            self.axes.set_xlabel("pixel number")
+
+        # Limits of axes
+        ylim = self.axes.get_ylim()
+        self.axes.set_xlim(x.min(), x.max())
+        self.update_lod()
+        self.axes.relim(visible_only=True)
+        limits = len(self.dataset) and self.dataset.ylim()
+        if limits:  # relim() ignores the collection of lines
+            ymin, ymax = limits
+            self.axes.update_datalim([(x.min(), ymin), (x.max(), ymax)])
+        self.axes.autoscale_view(scalex=False)
+
+        # Formatting - legend, zero level
+        self.update_legend(lines)
+        self.zero.set_visible(len(lines) > 0)
+        self.axes.yaxis.set_visible(len(lines) > 0)
+        self.axes.grid(self.grid, which='major', axis='both')
+
+        # Program help and file-related information
+        self.help_text.set_visible(self.help)
+        if self.show_info:
+            self.info_text.set_text(self.reader.read_info(filename))
+            self.info_text.set_position((x.min(), 0.0))
+        self.info_text.set_visible(self.show_info)
+
+        static = (self.legend_key, self.dataset.version, self.axes.get_xlim(),
+                  self.grid, self.help, self.show_info, self.diff_key,
+                  self.axes_diff and self.axes_diff.get_visible(),
+                  self.axes.get_xlabel())
+        if self.blit and self.background is not None and \
+           static == self.static and fits(self.axes.get_ylim(), ylim) and \
+           (diff_ylim is None or fits(self.axes_diff.get_ylim(), diff_ylim)):
+            self.axes.set_ylim(ylim)  # keep the background valid
+            if diff_ylim:
+                self.axes_diff.set_ylim(diff_ylim)
+            self.blit_animated()
         else:
-            self.axes.yaxis.set_visible(False)
-
-        if self.grid:
-            self.axes.grid(self.grid, which='major', axis='both')
-
-        # Display program help
-        if self.help is True:
-            self.help = \
-              self.figure.text(0.05, 0.5, KEYSTROKES, fontsize="medium",
-                               ha="left", va="center", family="monospace",
-                               bbox=self.boxprops)
-
-        # Display the file-related information
-        if self.show_info is True:
-            self.axes.text(x.min(), 0.0, self.reader.read_info(filename),
-                               fontsize="medium", ha="left", va="bottom",
-                               family="monospace", bbox=self.boxprops)
-        self.canvas.draw()
+            self.static = static
+            self.canvas.draw_idle()  # one redraw by the event loop
+
+    def view(self):
+        """ Return visible x-range and width of the plot in pixels """
+        xmin, xmax = self.axes.get_xlim()
+        return xmin, xmax, int(self.axes.bbox.width)
+
+    def update_lod(self, *args):
+        """ Reduce the plotted lines to the visible range and plot width. """
+        if self.current is None:
+            return
+        view = self.view()
+        filename, frame, x, y = self.current
+        cached = self.pyramids.pop((filename, frame), None)
+        if cached is None or cached[0] is not y:
+            cached = (y, MinMaxPyramid(x, y))
+        self.pyramids[(filename, frame)] = cached
+        if len(self.pyramids) > 16:
+            self.pyramids.popitem(last=False)
+        self.line.set_data(*cached[1].view(*view))
+        self.dataset.set_view(view)
+        if self.diff_lines and self.axes_diff.get_visible():
+            self.diff_lines.set_segments(self.diff_engine.segments(*view))
+
+    def animated(self):
+        """ Return artists, which are not part of the background. """
+        artists = [self.line, self.axes.title, self.info_text]
+        if self.legend:
+            artists.append(self.legend)
+        if self.diff_lines and self.axes_diff.get_visible():
+            artists.append(self.diff_lines)
+        return artists
+
+    def on_draw(self, event):
+        """ Save the background after a full redraw (blit mode). """
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        for artist in self.animated():
+            artist.axes.draw_artist(artist)
+
+    def blit_animated(self):
+        """ Restore the background and redraw only the animated artists. """
+        self.canvas.restore_region(self.background)
+        for artist in self.animated():
+            artist.axes.draw_artist(artist)
+        self.canvas.blit(self.figure.bbox)
+
+    def update_legend(self, lines):
+        """ Create the legend if the set of lines changed, or update it. """
+        if tuple(lines) != self.legend_key:
+            if self.legend:
+                self.legend.remove()
+                self.legend = None
+            if lines:
+                self.legend = self.axes.legend(lines,
+                                   [line.get_label() for line in lines],
+                                   loc="upper right", fontsize="small",
+                                   fancybox=True, frameon=True,
+                                   framealpha=0.6)
+                self.legend.draggable(True)
+                self.legend.set_animated(self.blit)
+                if len(lines) > 1:
+                    self.legend.set_title("Opened files")
+                else:
+                    self.legend.set_title("Opened file")
+            self.legend_key = tuple(lines)
+        elif self.legend:  # only the label of current file may change
+            for text, line in zip(self.legend.get_texts(), lines):
+                text.set_text(line.get_label())
+
+    def draw_diff(self, filename, x, y):
+        """ Update the lines on the axes with difference. """
+        if not self.diff_lines:
+            self.diff_lines = LineCollection([], linewidths=0.8, alpha=0.7,
+                                             animated=self.blit)
+            self.axes_diff.add_collection(self.diff_lines, autolim=False)
+            self.diff_zero = \
+                    self.axes_diff.axhline(0, color=line_styles.diff,
+                                           linestyle="--", lw=.75, alpha=.5)
+            self.axes_diff.tick_params(axis="y", labelcolor=line_styles.diff)
+        xdiff, result, refs = self.diff_engine.compute(filename, x, y)
+        self.diff_lines.set_segments(self.diff_engine.segments(*self.view()))
+        if len(refs) == 1:  # the only one is shown in the usual color
+            self.diff_lines.set_color(line_styles.diff)
+            self.diff_lines.set_linestyle("-")
+        else:  # the color and style of the stored line
+            styles = [line_styles.style(self.dataset[name].style)
+                      for name in refs]
+            self.diff_lines.set_color([color for color, ls in styles])
+            self.diff_lines.set_linestyle([ls for color, ls in styles])
+
+        # Axis label, zero level and legend depend on the mode
+        mode = self.diff_engine.mode
+        diff_key = (tuple(refs), mode)
+        if diff_key != self.diff_key:
+            self.diff_key = diff_key
+            if mode == "ratio":
+                self.diff_zero.set_ydata([1, 1])
+                self.axes_diff.set_ylabel("Ratio", color=line_styles.diff)
+            else:
+                self.diff_zero.set_ydata([0, 0])
+                if mode == "normalized":
+                    label = "Difference of normalized spectra"
+                else:
+                    label = "Difference in counts"
+                self.axes_diff.set_ylabel(label, color=line_styles.diff)
+            if self.diff_legend:
+                self.diff_legend.remove()
+                self.diff_legend = None
+            if refs:
+                if len(refs) == 1:
+                    label = "current vs.\n" + self.dataset[refs[0]].label()
+                else:
+                    label = "current vs.\n%i saved spectra" % len(refs)
+                proxy = Line2D([], [], color=line_styles.diff, label=label)
+                self.diff_legend = \
+                        self.axes_diff.legend([proxy], [label],
+                                              loc="center right",
+                                              fontsize="small", fancybox=True,
+                                              frameon=True, framealpha=0.6)
+                self.diff_legend.draggable(True)
+                self.diff_legend.set_title(mode.capitalize())
+
+        # Limits, the collection is not taken into account by relim()
+        self.axes_diff.relim()
+        if result.size:
+            with np.errstate(invalid="ignore"):
+                ymin, ymax = np.nanmin(result), np.nanmax(result)
+            if np.isfinite(ymin) and np.isfinite(ymax):
+                self.axes_diff.update_datalim([(xdiff[0], ymin),
+                                               (xdiff[-1], ymax)])
+        self.axes_diff.autoscale_view(scalex=False)
 
     def go_next(self):
         """ Open next SPE file (NOT calibration or dark, see config). """
-        self.spelist.append(self.spelist.pop(0))  # rotate circle forward
+        self.files.forward()
+        self.frame = 0
         self.visible = True
+        self.direction = 1
         self.draw()
+        self.prefetch()
 
     def go_prev(self):
         """ Display previous SPE file. """
-        self.spelist.insert(0, self.spelist.pop(-1))  # rotate circle backward
+        self.files.backward()
+        self.frame = 0
         self.visible = True
+        self.direction = -1
         self.draw()
+        self.prefetch()
+
+    def go_newest(self):
+        """ Display the most recent SPE file in the folder. """
+        if self.newest is None:
+            self.newest = max(self.files,
+                              key=lambda name: file_stamp(name) or (0, 0))
+        self.files.jump(self.newest)
+        self.frame = 0
+        self.visible = True
+        self.direction = -1
+        self.draw()
+        self.prefetch()
+
+    def go_frame(self, step):
+        """ Display another spectrum (frame) of the current file. """
+        if self.nframes > 1:
+            self.frame = (self.frame + step) % self.nframes
+            self.direction = 1 if step > 0 else -1
+            self.draw()
+            self.prefetch()
+
+    def check_new_files(self):
+        """ Add new files found by the watcher to the file index. """
+        added = False
+        for name in self.watcher.poll():
+            if self.reader.darks and name[:-4].endswith("dark"):
+                self.reader.darks.forget(name)
+            if name in self.files or name in self.excluded:
+                continue
+            self.files.insert(name)
+            if self.reader.store:
+                self.reader.update_store(name)
+                self.reader.store.save()
+            if self.reader.stitcher:
+                for stitched in self.reader.stitcher.update([name]):
+                    self.files.insert(stitched)
+            self.newest = name
+            added = True
+        if added:
+            if self.follow:
+                self.go_newest()
+            else:
+                self.prefetch()
+
+    def reload_pipeline(self):
+        """
+        Read the preprocessing stages from .speview.conf again and redraw.
+        Only the stages which changed are computed again.
+        """
+        cfg = cp.SafeConfigParser()
+        cfg.read(".speview.conf")
+        try:
+            self.reader.configure_pipeline(cfg)
+        except ValueError as err:
+            print "Pipeline is not changed: %s" % err
+            return
+        print "Pipeline: %s" % (", ".join(name for name, stage in
+                                          self.reader.pipeline.stages) or
+                                "no stages")
+        self.draw()
+        self.prefetch()
+
+    def check_calibration(self):
+        """
+        Redraw with the wavenumber axis as soon as the coefficients are
+        written (the report is rendered afterwards). The held lines get
+        the new axis at the same time as the new spectra.
+        """
+        running = self.reader.calibration_running()
+        calibration = self.reader.calibration
+        if calibration.update():
+            if self.dataset.xvals is not None:
+                npix = len(self.dataset.xvals)
+                self.dataset.set_axis(calibration.axis(npix))
+            self.draw()
+            self.prefetch()
+        if not running:
+            self.calibration_timer.stop()
+            calibration.frozen = False
+
+    def check_handoff(self):
+        """ Show the file opened by another call of speviewer. """
+        names = self.server.poll()
+        if not names:
+            return
+        name = names[-1]
+        if not os.path.isfile(name):
+            return
+        if name not in self.files:  # e.g. a dark or calibration file
+            self.files.insert(name)
+        self.files.jump(name)
+        self.frame = 0
+        self.visible = True
+        self.direction = 1
+        self.draw()
+        self.prefetch()
+        try:
+            self.canvas.manager.show()  # raise the window
+        except Exception:  # not supported by every backend
+            pass
+
+    def prefetch(self):
+        """ Read files around the current one in background. """
+        if not self.prefetcher:
+            return
+        current = (self.files.current, self.frame)
+        jobs = []
+        for i in range(1, self.prefetch_size + 1):
+            for step in (i * self.direction, -i * self.direction):
+                if self.nframes > 1:  # user goes through frames of the file
+                    job = (current[0], (self.frame + step) % self.nframes)
+                else:
+                    job = (self.files.neighbour(step), 0)
+                if job != current and job not in jobs:
+                    jobs.append(job)
+        self.prefetcher.request(jobs)
 
     def toggle(self):
         """ Toggle the state of the active line (saved or not). """
-        filename = self.spelist[0]
-        if self.dataset[filename].shape:
-            self.dataset.remove(self.spelist[0])
-        else:
-            self.dataset[filename] = self.reader.read_spe(filename)
+        filename = self.files.current
+        item = self.dataset.get(filename)
+        if item and item.frame == self.frame:
+            self.dataset.remove(filename)
+        else:  # another frame of the file could be stored, replace it
+            self.dataset.remove(filename)
+            x, y = self.reader.read_spe(filename, self.frame)
+            self.dataset[filename] = x, y, self.frame, self.nframes
         self.draw()
 
     def diff(self):
-        """ Subtract one spectrum from another one and plot the difference. """
-        filename = self.spelist[0]
-        keys = self.dataset.get_lines()
-        if filename in keys:
-            keys.remove(filename)
-        if len(keys):
-            if not self.axes_diff:
-                self.axes_diff = self.axes.twinx()
-            if len(keys) == 1:  # No choice - subtract it!
-                item = self.dataset[keys[0]]
-            else:  # Ask user which line he wants to subtract
-                ans = None
-                while not ans:
-                    ans = pz.List(("Saved spectra",), data=[keys],
-                          title="Select line to subtract")
-                item = self.dataset[ans[0]]
-            xcurr, ycurr = self.reader.read_spe(filename)
-            self.diffdata = (ycurr - item.yvals,
-                             mklbl(filename) + "\n" +
-                             mklbl(item.filename))
-            self.draw()
+        """
+        Compare the current spectrum with all saved ones and plot the
+        differences. If they are shown already, switch to the next mode
+        (difference, ratio, difference of normalized spectra).
+        """
+        refs = [name for name in self.dataset.get_lines()
+                if name != self.files.current]
+        if not refs:
+            print "Save a spectrum first (space bar) to compare with it"
+            return
+        if not self.axes_diff:
+            self.axes_diff = self.axes.twinx()
+            self.axes_diff.margins(0.0, 0.05)
+        elif self.axes_diff.get_visible():
+            self.diff_engine.next_mode()
+        self.axes_diff.set_visible(True)
+        self.draw()
 
     def diff_off(self):
         """ Get rid of difference line and axes """
-        if self.axes_diff:
-            self.axes_diff.cla()
-            self.axes_diff.yaxis.set_visible(False)
-            self.axes_diff = None
+        if self.axes_diff and self.axes_diff.get_visible():
+            self.axes_diff.set_visible(False)
             self.draw()
 
 